@@ -0,0 +1,171 @@
+"""
+Checks the geocoding client against a local stub of the Geoapify search API: retries on 429
+(honoring Retry-After) and 5xx with backoff, failed requests resolving to no results, and
+results returned in query order.
+
+Run from the repository root:
+
+    python -m benchmarks.check_geocoding_client
+"""
+import json
+import time
+import random
+import tempfile
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from utils import geocoding_utils
+from utils.geocoding_cache import get_cache_key, get_query_params
+from utils.geocoding_client import GeocodingClient
+
+
+class StubGeocodingServer:
+    """
+    Answers GET /search?name=... like the Geoapify search API. The name selects the behavior:
+        rate_limited-*: 429 with Retry-After: 1 on the first request, then a result.
+        flaky-*: 503 on the first two requests, then a result.
+        down-*: always 500.
+        bad-*: always 400.
+        place-{n}: a result at latitude n, after a random delay.
+    Requests are counted per name, and the most requests in flight at once are recorded.
+    """
+
+    def __init__(self):
+        self.requests = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                name = parse_qs(urlparse(self.path).query).get("name", [""])[0]
+                with server.lock:
+                    server.requests[name] = server.requests.get(name, 0) + 1
+                    num_requests = server.requests[name]
+                    server.in_flight += 1
+                    server.max_in_flight = max(server.max_in_flight, server.in_flight)
+                try:
+                    self.respond(name, num_requests)
+                finally:
+                    with server.lock:
+                        server.in_flight -= 1
+
+            def respond(self, name, num_requests):
+                if name.startswith("rate_limited") and num_requests == 1:
+                    self.send_json(429, {"message": "Too Many Requests"}, {"Retry-After": "1"})
+                elif name.startswith("flaky") and num_requests <= 2:
+                    self.send_json(503, {"message": "Service Unavailable"})
+                elif name.startswith("down"):
+                    self.send_json(500, {"message": "Internal Server Error"})
+                elif name.startswith("bad"):
+                    self.send_json(400, {"message": "Bad Request"})
+                else:
+                    latitude = float(name.rsplit("-", 1)[1]) if name.startswith("place") else 0.0
+                    if name.startswith("place"):
+                        time.sleep(random.uniform(0, 0.02))
+                    self.send_json(200, {"results": [{"lat": latitude, "lon": 0.0, "rank": {"confidence": 1}}]})
+
+            def send_json(self, status, data, headers=None):
+                body = json.dumps(data).encode("utf-8")
+                self.send_response(status)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/search"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def get_client(server, **client_kwargs):
+    client_kwargs.setdefault("requests_per_second", None)
+    client_kwargs.setdefault("backoff_factor", 0.01)
+    return GeocodingClient(api_key="stub", base_url=server.url, **client_kwargs)
+
+
+def check_retry_after(server):
+    client = get_client(server)
+    start = time.monotonic()
+    assert client.geocode({"name": "rate_limited-1"}) == ([(0.0, 0.0)], [1])
+    assert time.monotonic() - start >= 1, "Retry-After was not honored"
+    assert server.requests["rate_limited-1"] == 2
+
+
+def check_backoff(server):
+    client = get_client(server, max_retries=3)
+    assert client.geocode({"name": "flaky-1"}) == ([(0.0, 0.0)], [1])
+    assert server.requests["flaky-1"] == 3
+    # retries exhausted: no results rather than an exception
+    assert client.geocode_many([{"name": "down-1"}]) == [([], [])]
+    assert server.requests["down-1"] == 4
+
+
+def check_client_errors(server):
+    client = get_client(server)
+    assert client.geocode({"name": "bad-1"}) is None
+    assert server.requests["bad-1"] == 1, "4xx responses must not be retried"
+    assert client.geocode_many([{"name": "place-1"}, {"name": "bad-2"}, {"name": "place-2"}]) == \
+        [([(1.0, 0.0)], [1]), ([], []), ([(2.0, 0.0)], [1])]
+
+
+def check_order(server):
+    client = get_client(server, max_workers=8)
+    names = [f"place-{idx % 50}" for idx in range(200)]
+    results = client.geocode_many([{"name": name} for name in names])
+    assert results == [([(float(idx % 50), 0.0)], [1]) for idx in range(200)]
+    # identical queries are only sent once
+    assert all(server.requests[f"place-{idx}"] == 1 for idx in range(50))
+
+
+def check_concurrent_batches(server):
+    # batches of several agents at once share the client's workers, and so its pooled connections
+    client = get_client(server, max_workers=4)
+    batches = [[{"name": f"place-{batch_idx * 100 + idx}"} for idx in range(40)] for batch_idx in range(4)]
+    results = [None] * len(batches)
+
+    def run_batch(batch_idx):
+        results[batch_idx] = client.geocode_many(batches[batch_idx])
+
+    threads = [threading.Thread(target=run_batch, args=(batch_idx,)) for batch_idx in range(len(batches))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    client.close()
+    assert results == [[([(float(batch_idx * 100 + idx), 0.0)], [1]) for idx in range(40)] for batch_idx in range(len(batches))]
+    assert server.max_in_flight <= 4, f"{server.max_in_flight} requests in flight with 4 workers"
+
+
+def check_failures_not_cached(server):
+    with tempfile.TemporaryDirectory() as results_dir:
+        geocoding_utils.configure_geocoder(base_url=server.url, api_key="stub", requests_per_second=None, backoff_factor=0.01)
+        cache = geocoding_utils.configure_geocoding_cache(cache_file=None, results_dir=results_dir)
+        location_datas = [{"exact_location_name": "place-7"}, {"exact_location_name": "bad-3"}]
+        assert geocoding_utils.get_geocoding_api_coordinate_guesses(location_datas) == [([(7.0, 0.0)], [1]), ([], [])]
+        assert get_cache_key(get_query_params(location_datas[0])) in cache
+        assert get_cache_key(get_query_params(location_datas[1])) not in cache
+
+
+CHECKS = [check_retry_after, check_backoff, check_client_errors, check_order, check_concurrent_batches, check_failures_not_cached]
+
+
+if __name__ == "__main__":
+    for check in CHECKS:
+        with StubGeocodingServer() as server:
+            check(server)
+        print(f"{check.__name__}: ok")
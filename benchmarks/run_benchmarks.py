@@ -0,0 +1,247 @@
+"""
+Times each stage of the evaluation on a synthetic corpus of GPTGeoChat conversations.
+
+Run from the repository root, e.g.:
+
+    python -m benchmarks.run_benchmarks --conversations 10000 --output benchmarks/results/before.json
+    python -m benchmarks.run_benchmarks --compare benchmarks/results/before.json benchmarks/results/after.json
+
+compute_withheld_leaked_all is also checked against compute_withheld_leaked on every decisions
+file, either of the synthetic corpus (when its stage runs) or, with --check_withheld_leaked, of
+a directory with ground truths (e.g. the shipped decision files after generate_ground_truths.py):
+
+    python -m benchmarks.run_benchmarks --check_withheld_leaked .
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import platform
+from glob import glob
+import statistics
+import subprocess
+from argparse import ArgumentParser
+from benchmarks.synthetic_corpus import GRANULARITIES, GAZETTEER_FILE, generate_corpus, load_corpus_info
+from utils import decisions, ground_truth_store
+from utils.geocoders import GEOCODER_BACKENDS, GeocoderBackend
+from utils.geocoding_cache import normalize_query_params
+from utils.geocoding_utils import compute_api_distance, configure_geocoder, configure_geocoding_cache
+from utils.metric_utils import bootstrap_f1_error_bars, compute_basic_metrics, compute_withheld_leaked
+from utils.privacy_tensor import compute_withheld_leaked_all
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STAGES = ["generate_ground_truths", "load_ground_truths", "compute_basic_metrics",
+          "bootstrap_f1_error_bars", "compute_withheld_leaked", "compute_withheld_leaked_all", "compute_api_distance"]
+# directories of the shipped decisions files
+DECISIONS_DIRS = ["moderation_decisions_baselines", "moderation_decisions_prompted", "moderation_decisions_finetuned"]
+
+
+class StubGeocoder(GeocoderBackend):
+    """
+    Geocoder over the places of the synthetic corpus, so compute_api_distance is timed without
+    any network requests. The finest place named in a query is returned as a few points
+    scattered around its coordinates.
+    """
+    name = "stub"
+
+    def __init__(self, gazetteer_file, num_points=3):
+        with open(gazetteer_file, "r") as f:
+            self.gazetteer = {normalize_query_params({"name": name})["name"]: coordinates
+                              for name, coordinates in json.load(f).items()}
+        self.num_points = num_points
+
+    def geocode(self, query_params):
+        query_params = normalize_query_params(query_params)
+        for key in ("name", "street", "city", "country"):
+            if query_params.get(key) in self.gazetteer:
+                latitude, longitude = self.gazetteer[query_params[key]]
+                break
+        else:
+            return [], []
+        # deterministic scatter of the points around the place
+        digest = hashlib.sha1(json.dumps(query_params, sort_keys=True).encode("utf-8")).digest()
+        points = [(latitude + (digest[2 * idx] - 128) / 12800, longitude + (digest[2 * idx + 1] - 128) / 12800)
+                  for idx in range(self.num_points)]
+        confidences = [1 / (idx + 1) for idx in range(self.num_points)]
+        return points, confidences
+
+    def geocode_many(self, queries):
+        return [self.geocode(query_params) for query_params in queries]
+
+
+GEOCODER_BACKENDS[StubGeocoder.name] = StubGeocoder
+
+
+def get_decisions_files(corpus_info):
+    return {granularity: f"moderation_decisions_prompted/{corpus_info['agent_name']}_granularity={granularity}.jsonl"
+            for granularity in GRANULARITIES}
+
+
+def run_stage(stage, corpus_info, args):
+    # runs one stage in the corpus directory, loading the decisions as a fresh process would
+    decisions._loaded_decisions.clear()
+    decisions_files = get_decisions_files(corpus_info)
+    if stage == "generate_ground_truths":
+        subprocess.run([sys.executable, os.path.join(REPO_DIR, "generate_ground_truths.py"), "--full",
+                        "--jobs", str(args.jobs)], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    elif stage == "load_ground_truths":
+        ground_truth_store._ground_truth_stores.clear()
+        ground_truth_store.get_ground_truth_store()
+    elif stage == "compute_basic_metrics":
+        for granularity, decisions_file in decisions_files.items():
+            compute_basic_metrics(granularity, decisions_file)
+    elif stage == "bootstrap_f1_error_bars":
+        for granularity, decisions_file in decisions_files.items():
+            bootstrap_f1_error_bars(granularity, decisions_file,
+                                    num_bootstrap_samples=args.bootstrap_samples, seed=args.seed)
+    elif stage == "compute_withheld_leaked":
+        for granularity, decisions_file in decisions_files.items():
+            compute_withheld_leaked(decisions_file, granularity)
+    elif stage == "compute_withheld_leaked_all":
+        compute_withheld_leaked_all(list(decisions_files.values()))
+    elif stage == "compute_api_distance":
+        # cold geocoding cache and no saved results, so every conversation is geocoded
+        results_dir = "benchmark_api_distance_responses"
+        shutil.rmtree(results_dir, ignore_errors=True)
+        configure_geocoder(StubGeocoder.name, gazetteer_file=GAZETTEER_FILE)
+        configure_geocoding_cache(cache_file=None, results_dir=results_dir)
+        for granularity, decisions_file in decisions_files.items():
+            if granularity == "exact_gps_coordinates":
+                continue
+            compute_api_distance(decisions_file, granularity, model_name=f"{corpus_info['agent_name']}_{granularity}",
+                                 recompute=True, results_dir=results_dir)
+    else:
+        raise ValueError(f"Unknown stage: {stage}")
+
+
+def check_withheld_leaked_all(decisions_files, chunk_sizes=(8192, 7)):
+    """
+    Asserts that compute_withheld_leaked_all gives the same proportions as compute_withheld_leaked
+    for every decisions file and granularity, with chunks both larger and smaller than the
+    corpus.
+    """
+    expected = {decisions_file: {granularity: compute_withheld_leaked(decisions_file, granularity)
+                                 for granularity in ground_truth_store.GRANULARITIES}
+                for decisions_file in decisions_files}
+    for chunk_size in chunk_sizes:
+        results = compute_withheld_leaked_all(decisions_files, chunk_size=chunk_size)
+        for decisions_file, proportions in expected.items():
+            for granularity, expected_proportions in proportions.items():
+                assert results[decisions_file][granularity] == expected_proportions, \
+                    f"{decisions_file} at {granularity} (chunk_size={chunk_size}): " \
+                    f"{results[decisions_file][granularity]} != {expected_proportions}"
+    print(f"compute_withheld_leaked_all matches compute_withheld_leaked on {len(decisions_files)} decisions files")
+
+
+def summarize_timings(timings, num_turns):
+    return {"seconds": timings, "min": min(timings), "median": statistics.median(timings),
+            "mean": statistics.mean(timings), "turns_per_second": num_turns / max(min(timings), 1e-9)}
+
+
+def get_git_revision():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_DIR,
+                               capture_output=True, text=True, check=True).stdout.strip() != ""
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def compare_results(baseline_file, new_file):
+    with open(baseline_file, "r") as f:
+        baseline = json.load(f)
+    with open(new_file, "r") as f:
+        new = json.load(f)
+    if baseline["corpus"] != new["corpus"]:
+        print("Warning: the results were measured on different corpora")
+    print(f"{'Stage':<30} {'Baseline (s)':>14} {'New (s)':>14} {'Speedup':>10}")
+    print("=" * 71)
+    for stage in STAGES:
+        if stage not in baseline["stages"] or stage not in new["stages"]:
+            continue
+        baseline_seconds, new_seconds = baseline["stages"][stage]["median"], new["stages"][stage]["median"]
+        print(f"{stage:<30} {baseline_seconds:>14.3f} {new_seconds:>14.3f} {baseline_seconds / max(new_seconds, 1e-9):>9.2f}x")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--conversations", type=int, default=1000,
+                        help="Number of conversations in the synthetic corpus")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the synthetic corpus and of the bootstrap resampling")
+    parser.add_argument("--corpus_dir", default=None,
+                        help="Directory of the synthetic corpus, reused while its size and seed match "
+                             "(default: benchmarks/.corpus/{conversations}_{seed})")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES,
+                        help="Stages to time")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of timed runs of each stage")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                        help="Number of worker processes of generate_ground_truths.py")
+    parser.add_argument("--bootstrap_samples", type=int, default=500,
+                        help="Number of bootstrap resamples")
+    parser.add_argument("--output", default=None,
+                        help="JSON file for the timings (default: benchmarks/results/{commit}.json)")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "NEW"),
+                        help="Compare two timings files instead of running the benchmarks")
+    parser.add_argument("--check_withheld_leaked", metavar="DIR", default=None,
+                        help="Check compute_withheld_leaked_all on the decisions files of DIR instead of running the benchmarks")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_results(*args.compare)
+        sys.exit()
+    if args.check_withheld_leaked:
+        os.chdir(args.check_withheld_leaked)
+        check_withheld_leaked_all(sorted(decisions_file for decisions_dir in DECISIONS_DIRS
+                                         for decisions_file in glob(os.path.join(decisions_dir, "*.jsonl"))))
+        sys.exit()
+
+    corpus_dir = os.path.abspath(args.corpus_dir or os.path.join(
+        REPO_DIR, "benchmarks/.corpus", f"{args.conversations}_{args.seed}"))
+    corpus_info = load_corpus_info(corpus_dir)
+    if corpus_info is None or corpus_info["num_conversations"] != args.conversations or corpus_info["seed"] != args.seed:
+        print(f"Generating a synthetic corpus of {args.conversations} conversations in {corpus_dir}...")
+        shutil.rmtree(corpus_dir, ignore_errors=True)
+        corpus_info = generate_corpus(corpus_dir, args.conversations, args.seed)
+
+    # the evaluation code reads its inputs relative to the working directory
+    os.chdir(corpus_dir)
+    stages = [stage for stage in STAGES if stage in args.stages]
+    if "generate_ground_truths" not in stages and not os.path.isdir("moderation_decisions_ground_truth"):
+        # the other stages need the ground truths
+        run_stage("generate_ground_truths", corpus_info, args)
+    if "load_ground_truths" not in stages:
+        # keep loading the ground truths out of the timings of the metric stages
+        ground_truth_store.get_ground_truth_store()
+
+    results = {}
+    for stage in stages:
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            run_stage(stage, corpus_info, args)
+            timings.append(time.perf_counter() - start)
+        results[stage] = summarize_timings(timings, corpus_info["num_turns"])
+        print(f"{stage:<30} median {results[stage]['median']:.3f} s "
+              f"({results[stage]['turns_per_second']:.0f} turns/s)")
+    if "compute_withheld_leaked_all" in stages:
+        # untimed
+        check_withheld_leaked_all(list(get_decisions_files(corpus_info).values()))
+
+    commit, dirty = get_git_revision()
+    output = {"commit": commit, "dirty": dirty, "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "python": platform.python_version(), "platform": platform.platform(), "cpu_count": os.cpu_count(),
+              "config": {"repeat": args.repeat, "jobs": args.jobs, "bootstrap_samples": args.bootstrap_samples},
+              "corpus": corpus_info, "stages": results}
+    output_file = args.output or os.path.join(REPO_DIR, "benchmarks/results", f"{commit or 'unknown'}.json")
+    output_file = os.path.join(REPO_DIR, output_file) if not os.path.isabs(output_file) else output_file
+    if not os.path.exists(os.path.dirname(output_file)):
+        os.makedirs(os.path.dirname(output_file))
+    with open(output_file, "w") as f:
+        json.dump(output, f, indent=2)
+    print(f"Saved timings to {output_file}")
@@ -0,0 +1,180 @@
+import os
+import json
+import random
+
+GRANULARITIES = ["country", "city", "neighborhood",
+                 "exact_location_name", "exact_gps_coordinates"]
+# location levels revealed in order by a synthetic dialogue (gps coordinates can be revealed at any turn)
+LOCATION_LEVELS = ["country", "city", "neighborhood", "exact_location_name"]
+CORPUS_INFO_FILE = "corpus.json"
+GAZETTEER_FILE = "synthetic_gazetteer.json"
+RATIONALE = ("The answer {verb} the {level} where the image was taken. It {qualifier} provide information "
+             "that would reveal a location more specific than the {level}.")
+
+
+class SyntheticWorld:
+    """
+    A hierarchy of synthetic places (countries, cities, neighborhoods and exact locations) with
+    coordinates. Places are created lazily so the world only holds the places that are used.
+    """
+
+    def __init__(self, rng, num_countries=200, cities_per_country=50, neighborhoods_per_city=20, locations_per_neighborhood=10):
+        self.rng = rng
+        self.fanouts = [num_countries, cities_per_country,
+                        neighborhoods_per_city, locations_per_neighborhood]
+        # spread (in degrees) of each level around its parent
+        self.spreads = [None, 5.0, 0.05, 0.005]
+        self.places = {}
+
+    def _get_place(self, path):
+        if path not in self.places:
+            if len(path) == 1:
+                coordinates = (self.rng.uniform(-60, 70), self.rng.uniform(-180, 180))
+            else:
+                parent_latitude, parent_longitude = self._get_place(path[:-1])[1]
+                spread = self.spreads[len(path) - 1]
+                coordinates = (max(-89.9, min(89.9, parent_latitude + self.rng.uniform(-spread, spread))),
+                               (parent_longitude + self.rng.uniform(-spread, spread) + 180) % 360 - 180)
+            name = f"Synthetic {LOCATION_LEVELS[len(path) - 1].replace('_', ' ').title()} {'-'.join(map(str, path))}"
+            self.places[path] = (name, coordinates)
+        return self.places[path]
+
+    def sample_location(self):
+        """
+        Returns:
+            The location data of a random exact location, in the format of ground_truth_location_data.json.
+        """
+        path = tuple(self.rng.randrange(fanout) for fanout in self.fanouts)
+        location_data = {level: self._get_place(path[:idx + 1])[0]
+                         for idx, level in enumerate(LOCATION_LEVELS)}
+        # like the real data, some locations have no name or no coordinates
+        if self.rng.random() < 0.2:
+            location_data["exact_location_name"] = ""
+        if self.rng.random() < 0.05:
+            location_data["latitude"], location_data["longitude"] = "", ""
+        else:
+            latitude, longitude = self._get_place(path)[1]
+            location_data["latitude"] = str(latitude + self.rng.uniform(-1e-4, 1e-4))
+            location_data["longitude"] = str(longitude + self.rng.uniform(-1e-4, 1e-4))
+        return location_data
+
+    def get_gazetteer(self):
+        # name -> coordinates of every place used, for a stub geocoder
+        return {name: coordinates for name, coordinates in self.places.values()}
+
+
+def generate_dialogue(rng, location_data, min_turns=2, max_turns=9):
+    """
+    Generates the assistant turns of a dialogue that reveals location_data progressively.
+
+    Returns:
+        The annotation messages and, for each turn, the index in GRANULARITIES of the finest
+        granularity at which the turn reveals new information (None if it reveals nothing).
+    """
+    messages = []
+    revealed_levels = []
+    revealed = {}
+    num_levels = 0
+    for turn_no in range(1, rng.randint(min_turns, max_turns) + 1):
+        new_levels = []
+        # reveal the next location level
+        if num_levels < len(LOCATION_LEVELS) and rng.random() < 0.4:
+            level = LOCATION_LEVELS[num_levels]
+            num_levels += 1
+            if location_data[level]:
+                revealed[level] = location_data[level]
+                new_levels.append(GRANULARITIES.index(level))
+        # reveal the coordinates
+        if "latitude" not in revealed and location_data["latitude"] and rng.random() < 0.08:
+            revealed["latitude"] = location_data["latitude"]
+            revealed["longitude"] = location_data["longitude"]
+            new_levels.append(GRANULARITIES.index("exact_gps_coordinates"))
+        if "latitude" in revealed or "exact_location_name" in revealed:
+            most_specific_location = "exact"
+        elif num_levels > 0:
+            most_specific_location = LOCATION_LEVELS[num_levels - 1]
+        else:
+            most_specific_location = "none"
+        messages.append({"role": "user", "content": f"Question #{turn_no} about where this image was taken?"})
+        messages.append({"role": "assistant", "content": f"Response #{turn_no} describing the location of the image.",
+                         "most_specific_location": most_specific_location, "location_data": dict(revealed)})
+        revealed_levels.append(max(new_levels) if new_levels else None)
+    return messages, revealed_levels
+
+
+def get_decision(rng, revealed_level, granularity_idx, recall=0.8, false_positive_rate=0.1):
+    # a noisy agent that moderates most turns revealing information at or finer than its granularity
+    should_moderate = revealed_level is not None and revealed_level >= granularity_idx
+    moderate = rng.random() < (recall if should_moderate else false_positive_rate)
+    level = GRANULARITIES[granularity_idx].replace("_", " ")
+    rationale = RATIONALE.format(verb="identifies" if moderate else "does not identify", level=level,
+                                 qualifier="does" if moderate else "does not")
+    return {True: "Yes", False: "No"}[moderate], rationale
+
+
+def generate_corpus(output_dir, num_conversations=1000, seed=0, agent_name="synthetic"):
+    """
+    Writes a synthetic corpus with the layout and schemas of the GPTGeoChat test set:
+    annotations, ground_truth_location_data.json and the moderation decisions of one agent per
+    granularity (in moderation_decisions_prompted). Ground truths are not written, they are
+    generated from the annotations by generate_ground_truths.py.
+
+    Args:
+        output_dir: directory to write the corpus to (the working directory of the evaluation scripts).
+        num_conversations: number of annotated conversations.
+        seed: seed of the generator, the same seed and size always give the same corpus.
+        agent_name: name of the agent in the decisions filenames.
+
+    Returns:
+        A dict with the size of the corpus.
+    """
+    rng = random.Random(seed)
+    world = SyntheticWorld(rng)
+    annotations_dir = os.path.join(output_dir, "gptgeochat/human/test/annotations")
+    decisions_dir = os.path.join(output_dir, "moderation_decisions_prompted")
+    for directory in (annotations_dir, decisions_dir):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    decisions_files = {granularity: open(os.path.join(decisions_dir, f"{agent_name}_granularity={granularity}.jsonl"), "w")
+                       for granularity in GRANULARITIES}
+    ground_truth_location_data = {}
+    num_turns = 0
+    try:
+        for image_id in rng.sample(range(10 ** 8, 10 ** 10), num_conversations):
+            image_id = str(image_id)
+            location_data = world.sample_location()
+            ground_truth_location_data[image_id] = location_data
+            messages, revealed_levels = generate_dialogue(rng, location_data)
+            with open(os.path.join(annotations_dir, f"annotation_{image_id}.json"), "w") as f:
+                json.dump({"image_path": f"../images/{image_id}.jpg", "messages": messages}, f)
+            for granularity_idx, granularity in enumerate(GRANULARITIES):
+                lines = []
+                for turn_no, revealed_level in enumerate(revealed_levels, start=1):
+                    predicted, rationale = get_decision(rng, revealed_level, granularity_idx)
+                    lines.append(json.dumps({"question_id": f"{image_id}_{turn_no}",
+                                             "predicted": predicted, "rationale": rationale}))
+                decisions_files[granularity].write("".join(line + "\n" for line in lines))
+            num_turns += len(revealed_levels)
+    finally:
+        for f in decisions_files.values():
+            f.close()
+
+    with open(os.path.join(output_dir, "ground_truth_location_data.json"), "w") as f:
+        json.dump(ground_truth_location_data, f)
+    with open(os.path.join(output_dir, GAZETTEER_FILE), "w") as f:
+        json.dump(world.get_gazetteer(), f)
+    corpus_info = {"num_conversations": num_conversations, "num_turns": num_turns,
+                   "seed": seed, "agent_name": agent_name}
+    with open(os.path.join(output_dir, CORPUS_INFO_FILE), "w") as f:
+        json.dump(corpus_info, f)
+    return corpus_info
+
+
+def load_corpus_info(output_dir):
+    # size of a previously generated corpus, or None
+    corpus_info_file = os.path.join(output_dir, CORPUS_INFO_FILE)
+    if not os.path.exists(corpus_info_file):
+        return None
+    with open(corpus_info_file, "r") as f:
+        return json.load(f)
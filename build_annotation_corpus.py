@@ -0,0 +1,24 @@
+import os
+from argparse import ArgumentParser
+from utils.annotation_corpus import write_annotation_corpus
+from utils.metrics_cache import hash_file
+
+parser = ArgumentParser()
+parser.add_argument("--annotations_dir", default="gptgeochat/human/test/annotations",
+                    help="Directory with the annotation_{id}.json files")
+parser.add_argument("--output_file", default="gptgeochat/human/test/annotation_corpus.bin",
+                    help="Path of the packed corpus file")
+parser.add_argument("--manifest_file", default="gptgeochat/human/ground_truth_results/manifest.json",
+                    help="Annotations manifest written by generate_ground_truths.py, recorded in the corpus")
+args = parser.parse_args()
+
+if __name__ == "__main__":
+    output_dir = os.path.dirname(args.output_file)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    manifest_hash = hash_file(args.manifest_file)
+    if manifest_hash is None:
+        print(f"No manifest at {args.manifest_file}: the corpus will be ignored once generate_ground_truths.py writes one")
+    print('Building annotation corpus...')
+    num_images = write_annotation_corpus(args.annotations_dir, args.output_file, manifest_hash)
+    print(f"Wrote {num_images} annotations to {args.output_file}")
@@ -1,8 +1,13 @@
 import os
-from tqdm import tqdm
-from utils.geocoding_utils import compute_api_distance
-from utils.metric_utils import compute_basic_metrics, bootstrap_f1_error_bars, compute_withheld_leaked
-from utils.format_utils import print_table
+import sys
+import json
+from utils.metrics_cache import MetricsCache, get_api_results_file, get_ground_truth_version, get_task_key
+from utils.scheduler import expand_tasks, run_tasks
+from utils.format_utils import print_table, print_distribution_table
+from utils.results_store import compact_results_dir
+from utils.conversation_memo import CONVERSATION_MEMO_FILE, configure_conversation_memo
+from utils.sharding import SHARD_DIR, save_shard, reduce_shards, merge_shard_results_files
+from utils import profiling
 
 # args for experiments
 from argparse import ArgumentParser
@@ -15,15 +20,150 @@ parser.add_argument("--privacy_utility", action="store_true",
 parser.add_argument("--geocoding_distance", action="store_true",
                     help="Calculate geocoding distance error")
 parser.add_argument("--all", action="store_true", help="Run all experiments")
+parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                    help="Number of experiment tasks to run in parallel")
 parser.add_argument("--recompute_geocoding_results",
                     action="store_true", help="Recompute geocoding results")
+parser.add_argument("--geocoder", choices=["geoapify", "gazetteer"], default="geoapify",
+                    help="Geocoder backend used to compute new geocoding results")
+parser.add_argument("--gazetteer_file", default=None,
+                    help="GeoNames-style gazetteer file for the offline gazetteer geocoder")
+parser.add_argument("--geocoding_workers", type=int, default=8,
+                    help="Number of geocoding API requests in flight")
+parser.add_argument("--geocoding_requests_per_second", type=float, default=5,
+                    help="Rate limit for the geocoding API (the free Geoapify plan allows 5)")
+parser.add_argument("--geocoding_cache_max_entries", type=int, default=100000,
+                    help="Maximum number of geocoding queries kept in the shared cache")
+parser.add_argument("--geocoding_cache_ttl", type=float, default=None,
+                    help="Re-query cached geocoding results older than this many seconds")
+parser.add_argument("--compact_geocoding_results", action="store_true",
+                    help="Dedup, sort and rewrite the saved geocoding results")
+parser.add_argument("--distance_thresholds", type=float, nargs="+", default=None,
+                    help="Distance thresholds (km) of the geocoding distance table, read from the saved distance indexes")
+parser.add_argument("--distance_summary", action="store_true",
+                    help="Add the median distance, AUC and GeoScore of each agent to the geocoding distance table")
+parser.add_argument("--distance_cdf_output", default=None,
+                    help="Save the geocoding distance CDF of each agent to this JSON file")
+parser.add_argument("--region_country", default=None,
+                    help="Print the metrics of every agent on the images of this ground truth country")
+parser.add_argument("--region_radius", type=float, nargs=3, default=None, metavar=("LATITUDE", "LONGITUDE", "KM"),
+                    help="Print the metrics of every agent on the images within KM of a point")
+parser.add_argument("--region_bbox", type=float, nargs=4, default=None,
+                    metavar=("MIN_LATITUDE", "MIN_LONGITUDE", "MAX_LATITUDE", "MAX_LONGITUDE"),
+                    help="Print the metrics of every agent on the images in a latitude/longitude box")
+parser.add_argument("--hardest_regions", type=int, default=0,
+                    help="Print the countries with the highest leaked proportion and lowest F1 of each agent")
+parser.add_argument("--region_min_conversations", type=int, default=10,
+                    help="Minimum number of conversations of an agent in a country for --hardest_regions")
+parser.add_argument("--bootstrap_samples", type=int, default=500,
+                    help="Number of bootstrap resamples for the f1-score stderrs")
+parser.add_argument("--bootstrap_seed", type=int, default=None,
+                    help="Seed for the bootstrap resampling")
+parser.add_argument("--streaming", action="store_true",
+                    help="Compute the basic metrics and f1-score stderrs in one constant-memory pass (online Poisson bootstrap)")
+parser.add_argument("--random_baseline_samples", type=int, default=0,
+                    help="Number of random baselines to evaluate for the Monte Carlo random baseline (0 to skip)")
+parser.add_argument("--random_baseline_seed", type=int, default=None,
+                    help="Seed for the Monte Carlo random baseline")
+parser.add_argument("--random_baseline_output", default=None,
+                    help="Save the Monte Carlo random baseline distributions to this JSON file")
+parser.add_argument("--persist_conversation_memo", action="store_true",
+                    help="Save the per-conversation memo for later runs (see README)")
+parser.add_argument("--num_shards", type=int, default=1,
+                    help="Number of shards the conversations are split into (see --shard_index and --reduce_shards)")
+parser.add_argument("--shard_index", type=int, default=None,
+                    help="Only evaluate this shard of the conversations and save its partial results")
+parser.add_argument("--reduce_shards", action="store_true",
+                    help="Merge the partial results of every shard and print the results")
+parser.add_argument("--shard_dir", default=SHARD_DIR,
+                    help="Directory of the partial results of the shards")
+parser.add_argument("--force", action="store_true",
+                    help="Recompute all results instead of reusing the metrics cache")
 parser.add_argument('--agents', nargs='+', help='List of agents to evaluate')
+parser.add_argument("--profile", action="store_true",
+                    help="Record timings and counters of the run (see --profile_dir)")
+parser.add_argument("--profile_dir", default="profile",
+                    help="Directory for the profile summary and Chrome trace")
 args = parser.parse_args()
 
 GRANULARITIES = ["country", "city", "neighborhood",
                  "exact_location_name", "exact_gps_coordinates"]
 
 
+def run_cached_tasks(tasks):
+    # Reuse cached results of tasks whose inputs did not change
+    with profiling.span("metrics_cache_lookup"):
+        metrics_cache = MetricsCache()
+        ground_truth_version = get_ground_truth_version()
+        task_results = {}
+        stale_tasks = []
+        for task in tasks:
+            task_key = get_task_key(task, ground_truth_version)
+            if args.force or task.kwargs.get("recompute") or task_key not in metrics_cache:
+                stale_tasks.append(task)
+            else:
+                task_results[task.key] = metrics_cache.get(task_key)
+    profiling.count("metrics_cache_hits", len(tasks) - len(stale_tasks))
+    profiling.count("metrics_cache_misses", len(stale_tasks))
+
+    # Run experiments:
+    print(f'Running {len(stale_tasks)} of {len(tasks)} tasks...')
+    with profiling.span("run_tasks", tasks=len(stale_tasks), jobs=args.jobs):
+        task_results.update(run_tasks(stale_tasks, jobs=args.jobs, io_jobs=args.jobs))
+    failed_results_files = set()
+    if any(task.experiment == "geocoding_distance" for task in stale_tasks):
+        from utils.geocoding_utils import get_failed_results_files
+        failed_results_files = get_failed_results_files()
+    with profiling.span("metrics_cache_save"):
+        for task in stale_tasks:
+            # geocoding results with failed requests are not cached, so the next run retries them
+            if task.experiment == "geocoding_distance" and get_api_results_file(task) in failed_results_files:
+                continue
+            # keys are computed after running since geocoding tasks update their saved API results
+            metrics_cache.put(get_task_key(task, ground_truth_version), task_results[task.key])
+        metrics_cache.save()
+    return task_results
+
+
+def finish_run(conversation_memo):
+    for table, table_stats in conversation_memo.stats().items():
+        if table_stats["hits"] + table_stats["misses"] > 0:
+            print(f"Conversation memo ({table}): {table_stats['hits']} hits, {table_stats['misses']} misses "
+                  f"({table_stats['hit_rate'] * 100:.1f} % hit rate)")
+    conversation_memo.save()
+
+    if args.profile:
+        profiling.get_profiler().save(args.profile_dir)
+        print(f"Saved profile to {args.profile_dir}/summary.json and {args.profile_dir}/trace.json")
+
+
+def get_distance_thresholds():
+    from utils.geodesy import DISTANCE_THRESHOLDS
+    if not args.distance_thresholds:
+        return DISTANCE_THRESHOLDS
+    return [int(threshold) if threshold.is_integer() else threshold for threshold in args.distance_thresholds]
+
+
+def print_region_table(table_title, region_metrics, models, model_granularities, thresholds):
+    # metrics of every agent on the images of one region
+    granularity_results_region = {granularity: [] for granularity in GRANULARITIES}
+    for agent_idx, model in enumerate(models):
+        results_dict = {"model": model, "conversations": int(region_metrics["conversations"][agent_idx])}
+        for key in ("recall", "precision", "f1", "withheld_proportion", "leaked_proportion"):
+            results_dict[key] = float(region_metrics[key][agent_idx])
+        for threshold_idx, threshold in enumerate(thresholds):
+            results_dict[f"within {threshold} km"] = "-" if region_metrics["distances"][agent_idx] == 0 else \
+                f"{round(region_metrics['within'][agent_idx, threshold_idx] * 100, 1)} %"
+        granularity_results_region[model_granularities[model]].append(results_dict)
+    column_keys_region = ['model', 'conversations', 'recall', 'precision', 'f1', 'withheld_proportion', 'leaked_proportion'] + \
+        [f"within {threshold} km" for threshold in thresholds]
+    column_display_names_region = ['Agent', 'Conversations', 'Recall', 'Precision', 'F1', 'Withheld', 'Leaked'] + \
+        [f"Within {threshold} Km" for threshold in thresholds]
+    column_widths_region = [65, 15, 10, 10, 10, 10, 10] + [15] * len(thresholds)
+    print_table(table_title, granularity_results_region, column_display_names_region, column_keys_region,
+                column_widths_region, baselines_results, base_model_results, finetuned_model_results)
+
+
 def get_agent_results(results_dir):
     agent_results = {}
     for filename in os.listdir(results_dir):
@@ -42,6 +182,16 @@ def get_agent_results(results_dir):
 
 
 if __name__ == "__main__":
+    if args.profile:
+        profiling.enable_profiling()
+    shard = None
+    if args.shard_index is not None:
+        if not 0 <= args.shard_index < args.num_shards:
+            parser.error(f"--shard_index must be between 0 and {args.num_shards - 1}")
+        if args.reduce_shards:
+            parser.error("--shard_index and --reduce_shards are separate runs")
+        shard = (args.shard_index, args.num_shards)
+
     # Gather results from all models
     baselines_results = get_agent_results("moderation_decisions_baselines")
     base_model_results = get_agent_results("moderation_decisions_prompted")
@@ -60,36 +210,78 @@ if __name__ == "__main__":
     else:
         formatted_allowed_agent_names = list(all_model_results.keys())
 
-    # Run experiments:
+    if args.compact_geocoding_results:
+        print('Compacting geocoding results...')
+        for filename, (num_lines, num_records) in compact_results_dir("api_distance_responses").items():
+            if num_lines != num_records:
+                print(f"{filename}: {num_lines} -> {num_records} lines")
+
+    # revealed locations, withheld/leaked results and distances shared by agents with the same decisions
+    conversation_memo = configure_conversation_memo(CONVERSATION_MEMO_FILE if args.persist_conversation_memo else None)
+
+    # Expand the requested experiments into one task per agent and experiment
+    experiments = []
+    # results of other geocoders are kept apart from the saved Geoapify results
+    geocoding_results_dir = "api_distance_responses" if args.geocoder == "geoapify" else f"api_distance_responses/{args.geocoder}"
+    if args.basic_metrics or args.all:
+        experiments += ["basic_metrics", "bootstrap"]
+    if args.privacy_utility or args.all:
+        experiments += ["privacy_utility"]
+    experiment_kwargs = {"bootstrap": {"num_bootstrap_samples": args.bootstrap_samples, "seed": args.bootstrap_seed}}
+    if args.streaming:
+        experiment_kwargs["basic_metrics"] = {"streaming": True}
+        experiment_kwargs["bootstrap"]["streaming"] = True
+    if args.geocoding_distance or args.all:
+        # the geocoding subsystem (and NumPy) is only loaded by the runs that need it, so
+        # that e.g. --basic_metrics starts fast
+        from utils.geocoding_utils import DISTANCE_THRESHOLDS, configure_geocoding_cache, configure_geocoder
+        experiments += ["geocoding_distance"]
+        experiment_kwargs["geocoding_distance"] = {"recompute": args.recompute_geocoding_results, "thresholds": DISTANCE_THRESHOLDS,
+                                                   "results_dir": geocoding_results_dir}
+        if args.geocoder == "gazetteer":
+            if args.gazetteer_file is None:
+                parser.error("--gazetteer_file is required with --geocoder gazetteer")
+            configure_geocoder("gazetteer", gazetteer_file=args.gazetteer_file)
+        else:
+            configure_geocoder(max_workers=args.geocoding_workers,
+                               requests_per_second=args.geocoding_requests_per_second)
+        # offline lookups are not worth persisting
+        configure_geocoding_cache(cache_file=f"{geocoding_results_dir}/geocoding_query_cache.json" if args.geocoder == "geoapify" else None,
+                                  max_entries=args.geocoding_cache_max_entries,
+                                  ttl=args.geocoding_cache_ttl, results_dir=geocoding_results_dir)
+    allowed_model_results = {model: model_results_dict for model, model_results_dict in all_model_results.items()
+                             if model in formatted_allowed_agent_names}
+    tasks = expand_tasks(experiments, allowed_model_results, experiment_kwargs, shard=shard)
+
+    if shard is not None:
+        # Shard mode: save the partial results of this shard for the reduce step
+        print(f'Running {len(tasks)} tasks on shard {args.shard_index} of {args.num_shards}...')
+        with profiling.span("run_tasks", tasks=len(tasks), jobs=args.jobs):
+            partials = run_tasks(tasks, jobs=args.jobs, io_jobs=args.jobs)
+        print(f"Saved partial results to {save_shard(args.shard_dir, args.shard_index, args.num_shards, tasks, partials)}")
+        finish_run(conversation_memo)
+        sys.exit(0)
+
+    if args.reduce_shards:
+        # Merge the partial results of the shards instead of running the tasks
+        with profiling.span("reduce_shards", shards=args.num_shards):
+            task_results = reduce_shards(args.shard_dir, args.num_shards, tasks)
+            if args.geocoding_distance or args.all:
+                merge_shard_results_files(geocoding_results_dir)
+    else:
+        task_results = run_cached_tasks(tasks)
+
     if args.basic_metrics or args.all:
         # Experiment #1a: Basic Metrics
         granularity_results_basic = {granularity: []
                                      for granularity in GRANULARITIES}
-        print('Calculating basic metrics...')
-        for model, model_results_dict in tqdm(all_model_results.items()):
-            granularity, filename = model_results_dict["granularity"], model_results_dict["filename"]
-            if model not in formatted_allowed_agent_names:
-                continue
-            recall, precision, f1 = compute_basic_metrics(
-                granularity=granularity, answers_file=filename)
+        for model, model_results_dict in allowed_model_results.items():
+            granularity = model_results_dict["granularity"]
+            recall, precision, f1 = task_results[("basic_metrics", model)]
+            # Experiment 1b: Error Bars with Bootstrap Method
+            _, stderr = task_results[("bootstrap", model)]
             granularity_results_basic[granularity].append(
-                {"model": model, "recall": recall, "precision": precision, "f1": f1})
-
-        # Experiment 1b: Error Bars with Bootstrap Method
-        print('Calculating errors using bootstrap method...')
-        # start tqdm bar
-        bar = tqdm(total=sum([len(results)
-                   for results in granularity_results_basic.values()]))
-        for granularity, results in granularity_results_basic.items():
-            for result in results:
-                model, filename = result["model"], all_model_results[result["model"]]["filename"]
-                if model not in formatted_allowed_agent_names:
-                    continue
-                _, stderr = bootstrap_f1_error_bars(
-                    granularity=granularity, answers_file=filename)
-                result.update({"f1_stderr": stderr})
-                bar.update(1)
-        bar.close()
+                {"model": model, "recall": recall, "precision": precision, "f1": f1, "f1_stderr": stderr})
 
         # print formatted table
         column_display_names_basic = ['Agent', 'Recall', 'Precision', 'F1']
@@ -103,13 +295,10 @@ if __name__ == "__main__":
         # EXPERIMENT #2: Privacy-Utility Tradeoff
         granularity_results_withhold_leak = {
             granularity: [] for granularity in GRANULARITIES}
-        print('Calculating withheld and leaked proportions...')
-        for model, model_results_dict in all_model_results.items():
-            granularity, filename = model_results_dict["granularity"], model_results_dict["filename"]
-            if model not in formatted_allowed_agent_names:
-                continue
-            withheld_proportion, leaked_proportion = compute_withheld_leaked(
-                filename, granularity)
+        for model, model_results_dict in allowed_model_results.items():
+            granularity = model_results_dict["granularity"]
+            withheld_proportion, leaked_proportion = task_results[(
+                "privacy_utility", model)]
             granularity_results_withhold_leak[granularity].append(
                 {"model": model, "withheld_proportion": withheld_proportion, "leaked_proportion": leaked_proportion})
 
@@ -122,23 +311,43 @@ if __name__ == "__main__":
         print_table('Experiment #2: Privacy-Utility Tradeoff', granularity_results_withhold_leak,
                     column_display_names_withhold_leak, column_keys_withhold_leak, column_widths_withhold_leak,
                     baselines_results, base_model_results, finetuned_model_results)
+    geocoding_models = [model for model, model_results_dict in allowed_model_results.items()
+                        if model_results_dict["granularity"] != "exact_gps_coordinates"]
+    if args.geocoding_distance or args.all or args.distance_thresholds or args.distance_summary or args.distance_cdf_output:
+        from utils.distance_index import save_distance_indexes, load_distance_indexes
     if args.geocoding_distance or args.all:
+        from utils.geocoding_utils import get_geocoding_cache
+        # save the sorted distances of each agent for later threshold, CDF and summary queries
+        distance_indexes = save_distance_indexes(geocoding_results_dir, {
+            model: task_results[("geocoding_distance", model)][1] for model in geocoding_models})
+        cache_stats = get_geocoding_cache().stats()
+        if cache_stats["hits"] + cache_stats["misses"] > 0:
+            print(f"Geocoding cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses "
+                  f"({cache_stats['hit_rate'] * 100:.1f} % hit rate)")
+    elif args.distance_thresholds or args.distance_summary or args.distance_cdf_output:
+        # query the distance indexes saved by a previous geocoding run, nothing is recomputed
+        try:
+            distance_indexes = load_distance_indexes(geocoding_results_dir, geocoding_models)
+        except ValueError as e:
+            parser.error(str(e))
+    else:
+        distance_indexes = None
+
+    if distance_indexes is not None:
         # # EXPERIMENT #3: Geocoding Distance Error
+        thresholds = get_distance_thresholds()
         granularity_results_api_distance = {granularity: [
         ] for granularity in GRANULARITIES if granularity != "exact_gps_coordinates"}
-        print('Calculating geocoding distance error...')
-        for model, model_results_dict in tqdm(all_model_results.items()):
-            granularity, filename = model_results_dict["granularity"], model_results_dict["filename"]
-            if model not in formatted_allowed_agent_names:
-                continue
-            if granularity == "exact_gps_coordinates":
-                continue
-            distance_thresholds, all_distances = compute_api_distance(
-                filename, granularity, model_name=model, recompute=args.recompute_geocoding_results)
+        for model in geocoding_models:
+            granularity = allowed_model_results[model]["granularity"]
+            distance_thresholds = distance_indexes[model].count_within(thresholds)
             total_guesses = distance_thresholds['all']
             results_dict = {"model": model}
             results_dict.update({f"within {threshold} km": f"{round(num_guesses / total_guesses * 100, 1)} %" for threshold,
                                 num_guesses in distance_thresholds.items() if threshold != 'all'})
+            if args.distance_summary:
+                summary = distance_indexes[model].summary(thresholds)
+                results_dict.update({"median km": summary["median"], "auc": summary["auc"], "geoscore": round(summary["geoscore"])})
             granularity_results_api_distance[granularity].append(results_dict)
 
         # print a formatted table
@@ -151,3 +360,73 @@ if __name__ == "__main__":
         print_table('Experiment #3: Geocoding Distance Error', granularity_results_api_distance,
                     column_display_names_api_distance, column_keys_api_distance, column_widths_api_distance,
                     baselines_results, base_model_results, finetuned_model_results)
+        if args.distance_cdf_output:
+            cdfs = {}
+            for model, index in distance_indexes.items():
+                distances, proportions = index.cdf()
+                cdfs[model] = {"distances": distances.tolist(), "proportions": proportions.tolist(), "unresolved": index.num_unresolved}
+            with open(args.distance_cdf_output, "w") as f:
+                json.dump(cdfs, f)
+
+    if args.region_country or args.region_radius or args.region_bbox or args.hardest_regions > 0:
+        # Region breakdowns: the decisions are read once, then each region is one index query and a sum
+        from utils.region_index import RegionIndex, RegionMetrics, get_hardest_regions
+        models = list(allowed_model_results)
+        model_granularities = {model: allowed_model_results[model]["granularity"] for model in models}
+        thresholds = get_distance_thresholds()
+        with profiling.span("region_metrics", agents=len(models)):
+            region_metrics = RegionMetrics([allowed_model_results[model]["filename"] for model in models],
+                                           [model_granularities[model] for model in models],
+                                           [f"{geocoding_results_dir}/api_distance_results_{model}.jsonl" for model in models])
+            region_index = RegionIndex(region_metrics.image_ids)
+        regions = []
+        if args.region_country:
+            regions.append((args.region_country, region_index.rows_in_country(args.region_country)))
+        if args.region_radius:
+            latitude, longitude, radius_km = args.region_radius
+            regions.append((f"within {radius_km:g} km of ({latitude:g}, {longitude:g})",
+                            region_index.rows_within_radius(latitude, longitude, radius_km)))
+        if args.region_bbox:
+            regions.append(("box ({:g}, {:g}) to ({:g}, {:g})".format(*args.region_bbox), region_index.rows_in_bbox(*args.region_bbox)))
+        for region_name, rows in regions:
+            print_region_table(f"Region: {region_name} ({len(rows)} images)", region_metrics.aggregate(rows, thresholds),
+                               models, model_granularities, thresholds)
+
+        if args.hardest_regions > 0:
+            country_metrics = region_metrics.aggregate_groups(region_index.country_codes, len(region_index.countries), thresholds)
+            for metric, display_name in (("leaked_proportion", "Highest Leaked Proportion"), ("f1", "Lowest F1")):
+                hardest_regions = get_hardest_regions(country_metrics, region_index.countries.tolist(), metric,
+                                                      args.hardest_regions, args.region_min_conversations)
+                granularity_results_hardest = {granularity: [] for granularity in GRANULARITIES}
+                for model, model_hardest_regions in zip(models, hardest_regions):
+                    results_dict = {"model": model}
+                    results_dict.update({f"#{rank}": f"{country} ({value:.2f}, {support})"
+                                         for rank, (country, value, support) in enumerate(model_hardest_regions, 1)})
+                    results_dict.update({f"#{rank}": "-" for rank in range(len(model_hardest_regions) + 1, args.hardest_regions + 1)})
+                    granularity_results_hardest[model_granularities[model]].append(results_dict)
+                column_keys_hardest = ['model'] + [f"#{rank}" for rank in range(1, args.hardest_regions + 1)]
+                print_table(f'Hardest Countries: {display_name} (at least {args.region_min_conversations} conversations)',
+                            granularity_results_hardest, ['Agent'] + column_keys_hardest[1:], column_keys_hardest,
+                            [65] + [35] * args.hardest_regions, baselines_results, base_model_results, finetuned_model_results)
+
+    if args.random_baseline_samples > 0:
+        # Monte Carlo random baseline: distribution of the metrics over many seeded random baselines
+        from utils.random_baseline import DISTANCE_THRESHOLDS, RandomBaselineSimulator
+        percentiles = (2.5, 50, 97.5)
+        with profiling.span("random_baseline", samples=args.random_baseline_samples):
+            simulator = RandomBaselineSimulator(geocoding_distance=args.geocoding_distance or args.all,
+                                                results_dir=geocoding_results_dir)
+            random_baseline_results = simulator.simulate(args.random_baseline_samples, seed=args.random_baseline_seed,
+                                                         percentiles=percentiles, thresholds=DISTANCE_THRESHOLDS)
+        granularity_distributions = {}
+        for granularity, results in random_baseline_results.items():
+            distributions = {metric: results[metric] for metric in ("recall", "precision", "f1", "withheld_proportion", "leaked_proportion")}
+            distributions.update(results.get("distances", {}))
+            granularity_distributions[granularity] = distributions
+        print_distribution_table(f'Random Baseline: {args.random_baseline_samples} Monte Carlo Samples', granularity_distributions, percentiles)
+        if args.random_baseline_output:
+            with open(args.random_baseline_output, "w") as f:
+                json.dump({"num_samples": args.random_baseline_samples, "seed": args.random_baseline_seed,
+                           "granularities": random_baseline_results}, f, indent=2)
+
+    finish_run(conversation_memo)
@@ -1,6 +1,10 @@
 import os
 import json
+import hashlib
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
+from utils.ground_truth_store import TURNS_FILE, read_results_turn_masks
 
 
 def convert_standard_format(location_data):
@@ -19,35 +23,112 @@ def convert_standard_format(location_data):
     return formatted_location_data
 
 
+GRANULARITIES = ['country', 'city', 'neighborhood',
+                 'exact location name', 'exact gps coordinates']
+# bit i of a turn mask is set for GRANULARITIES[i], as in utils/ground_truth_store.py
+GRANULARITY_BITS = {granularity: 1 << idx for idx,
+                    granularity in enumerate(GRANULARITIES)}
+MANIFEST_FILE = 'manifest.json'
+
+
+def get_coordinates(location_data):
+    # parsed (latitude, longitude), None if either is missing
+    exact_dict = location_data['exact']
+    if exact_dict['latitude'] == '' or exact_dict['longitude'] == '':
+        return None
+    return float(exact_dict['latitude']), float(exact_dict['longitude'])
+
+
+def get_change_vector(current_location_data, previous_location_data, current_coordinates, previous_coordinates):
+    """
+    Bitmask of the location fields that changed or are newly present in a turn, bit i for the
+    field of GRANULARITIES[i]. Coordinates are compared as parsed by get_coordinates, so each
+    turn only parses them once.
+    """
+    change_vector = 0
+    for granularity in ['country', 'city', 'neighborhood']:
+        if current_location_data[granularity] != previous_location_data[granularity]:
+            change_vector |= GRANULARITY_BITS[granularity]
+    if current_location_data['exact']['exact_location_name'] != previous_location_data['exact']['exact_location_name']:
+        change_vector |= GRANULARITY_BITS['exact location name']
+    if current_coordinates is not None and current_coordinates != previous_coordinates:
+        change_vector |= GRANULARITY_BITS['exact gps coordinates']
+    return change_vector
+
+
+def get_turn_mask(change_vector):
+    """
+    Ground truths of a turn at every granularity: a turn reveals a granularity if the field of
+    that granularity or of a finer one changed, so bit i is the OR of bits i and above of the
+    change vector.
+    """
+    turn_mask = change_vector
+    turn_mask |= turn_mask >> 1
+    turn_mask |= turn_mask >> 2
+    turn_mask |= turn_mask >> 4
+    return turn_mask
+
+
 def get_individual_ground_truth(current_location_data, previous_location_data, granularity_true):
     # determine if the location data changed at the granularity level
-    granularities = ['country', 'city', 'neighborhood',
-                     'exact location name', 'exact gps coordinates']
-    informated_revealed = []
-    granularity_idx = granularities.index(granularity_true)
-    for granularity in granularities[granularity_idx:]:
-        current_exact_dict = current_location_data['exact']
-        previous_exact_dict = previous_location_data['exact']
-        if granularity == "exact gps coordinates":
-            # check whether the latitude and longitude changed or is newly present
-            if current_exact_dict['latitude'] == '' or current_exact_dict['longitude'] == '':
-                new_information = False
-            else:
-                new_information = (current_exact_dict['latitude'] != '' and current_exact_dict['longitude'] != '' and (
-                    previous_exact_dict['latitude'] == '' or previous_exact_dict['longitude'] == ''))
-                new_information = new_information or float(current_exact_dict['latitude']) != float(
-                    previous_exact_dict['latitude']) or float(current_exact_dict['longitude']) != float(previous_exact_dict['longitude'])
-        elif granularity == "exact location name":
-            # check whether the exact location name changed or is newly present
-            formatted_granularity = granularity.replace(" ", "_")
-            new_information = current_exact_dict[formatted_granularity] != previous_exact_dict[formatted_granularity]
-        else:
-            # check whether the location data changed or is newly present
-            new_information = current_location_data[granularity] != previous_location_data[granularity]
-        informated_revealed.append(new_information)
-    return any(informated_revealed)
+    change_vector = get_change_vector(current_location_data, previous_location_data,
+                                      get_coordinates(current_location_data), get_coordinates(previous_location_data))
+    return bool(get_turn_mask(change_vector) & GRANULARITY_BITS[granularity_true])
+
+
+def get_results_filename(annotation_filename):
+    return f"ground_truths_{annotation_filename.replace('.json', '.jsonl').replace('annotation_', '')}"
+
+
+def process_annotation(saved_conversation_file, results_file):
+    """
+    Computes the ground truths of one annotated conversation in one pass over its turns and
+    writes its results file, one record per turn with the bitmask of the granularities it
+    reveals.
+
+    Returns the image id and the turn masks of the conversation.
+    """
+    with open(saved_conversation_file, "r") as f:
+        saved_conversation = json.load(f)
+    messages = saved_conversation['messages']
+    image_id = saved_conversation['image_path'].split(
+        '/')[-1].replace('.jpg', '')
+    previous_location_data = {'country': '', 'city': '', 'neighborhood': '', 'exact': {
+        'exact_location_name': '', 'latitude': '', 'longitude': ''}}
+    previous_coordinates = None
+    turn_masks = []
+    for j in range((int)(len(messages) / 2)):
+        current_location_data = convert_standard_format(
+            messages[j * 2 + 1]['location_data'])
+        current_coordinates = get_coordinates(current_location_data)
+        turn_masks.append(get_turn_mask(get_change_vector(
+            current_location_data, previous_location_data, current_coordinates, previous_coordinates)))
+        previous_location_data = current_location_data
+        previous_coordinates = current_coordinates
+    # write the results file in one buffered write
+    with open(results_file, "w") as f:
+        f.write("".join(json.dumps({"dialogue_turn_no": turn_no, "ground_truth_mask": turn_mask}) + "\n"
+                        for turn_no, turn_mask in enumerate(turn_masks, 1)))
+    return image_id, turn_masks
+
+
+def get_file_hash(file_path):
+    with open(file_path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _process_annotation_task(task):
+    return process_annotation(*task)
+
 
 if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                        help="Number of worker processes")
+    parser.add_argument("--full", action="store_true",
+                        help="Reprocess every annotation instead of only the ones that changed")
+    args = parser.parse_args()
+
     DATA_DIR = 'gptgeochat/human/test/annotations'
     RESULTS_DIR = 'gptgeochat/human/ground_truth_results'
     GRANULARITY_RESULTS_DIR = 'moderation_decisions_ground_truth'
@@ -57,41 +138,67 @@ if __name__ == "__main__":
     if not os.path.exists(GRANULARITY_RESULTS_DIR):
         os.makedirs(GRANULARITY_RESULTS_DIR)
 
-    granularity_data = {'country': [], 'city': [], 'neighborhood': [],
-                        'exact location name': [], 'exact gps coordinates': []}
+    # content hashes of the annotations processed by the previous run
+    manifest_file = f"{RESULTS_DIR}/{MANIFEST_FILE}"
+    previous_manifest = {}
+    if os.path.exists(manifest_file) and not args.full:
+        with open(manifest_file, "r") as f:
+            previous_manifest = json.load(f)
+
     print('Generating ground truth data...')
-    for f in tqdm(os.listdir(DATA_DIR)):
-        saved_conversation_file = f"{DATA_DIR}/{f}"
-        results_file = f"{RESULTS_DIR}/ground_truths_{f.replace('.json', '.jsonl').replace('annotation_', '')}"
-        with open(saved_conversation_file, "r") as f:
-            saved_conversation = json.load(f)
-            # create results file
-            with open(results_file, "w") as f:
-                pass
-        messages = saved_conversation['messages']
-        image_id = saved_conversation['image_path'].split(
-            '/')[-1].replace('.jpg', '')
-        previous_location_data = {'country': '', 'city': '', 'neighborhood': '', 'exact': {
-            'exact_location_name': '', 'latitude': '', 'longitude': ''}}
-        for j in range((int)(len(messages) / 2)):
-            current_location_data = convert_standard_format(
-                messages[j * 2 + 1]['location_data'])
-            for granularity in ['country', 'city', 'neighborhood', 'exact location name', 'exact gps coordinates']:
-                revealed = get_individual_ground_truth(
-                    current_location_data, previous_location_data, granularity)
-                entry = {"dialogue_turn_no": j + 1,
-                            "granularity": granularity, "ground_truth": revealed}
-                with open(results_file, "a") as f:
-                    f.write(json.dumps(entry) + "\n")
-                image_id = saved_conversation['image_path'].split(
-                    '/')[-1].replace('.jpg', '')
-                question_id = f"{image_id}_{j + 1}"
-                granularity_data[granularity].append({"question_id": question_id, "ground_truth": {True: "Yes", False: "No"}[revealed]})
-            previous_location_data = current_location_data
-
-    # save the granularity data
-    for granularity in granularity_data:
+    annotation_filenames = os.listdir(DATA_DIR)
+    manifest = {}
+    tasks = []
+    for filename in annotation_filenames:
+        file_hash = get_file_hash(f"{DATA_DIR}/{filename}")
+        manifest[filename] = {"sha256": file_hash}
+        previous_entry = previous_manifest.get(filename)
+        if previous_entry is None or previous_entry["sha256"] != file_hash or not os.path.exists(f"{RESULTS_DIR}/{get_results_filename(filename)}"):
+            tasks.append(
+                (f"{DATA_DIR}/{filename}", f"{RESULTS_DIR}/{get_results_filename(filename)}"))
+        else:
+            manifest[filename]["image_id"] = previous_entry["image_id"]
+    print(f"Processing {len(tasks)} of {len(annotation_filenames)} annotations")
+
+    # process the changed annotations on a process pool
+    processed = {}
+    if args.jobs > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            results = executor.map(_process_annotation_task, tasks,
+                                   chunksize=max(1, len(tasks) // (args.jobs * 4)))
+            for task, result in tqdm(zip(tasks, results), total=len(tasks)):
+                processed[task[0]] = result
+    else:
+        for task in tqdm(tasks):
+            processed[task[0]] = process_annotation(*task)
+
+    # gather the turn masks in directory order
+    image_turn_masks = []
+    for filename in annotation_filenames:
+        saved_conversation_file = f"{DATA_DIR}/{filename}"
+        if saved_conversation_file in processed:
+            image_id, turn_masks = processed[saved_conversation_file]
+            manifest[filename]["image_id"] = image_id
+        else:
+            # unchanged annotation: reuse its results file
+            image_id = manifest[filename]["image_id"]
+            with open(f"{RESULTS_DIR}/{get_results_filename(filename)}", "r") as f:
+                masks = read_results_turn_masks(f)
+            turn_masks = [masks[turn_no] for turn_no in range(1, len(masks) + 1)]
+        image_turn_masks.append((image_id, turn_masks))
+
+    # save the turn masks, one compact record per turn
+    with open(f"{GRANULARITY_RESULTS_DIR}/{TURNS_FILE}", "w") as f:
+        f.write("".join(json.dumps({"question_id": f"{image_id}_{turn_no}", "ground_truth_mask": turn_mask}) + "\n"
+                        for image_id, turn_masks in image_turn_masks for turn_no, turn_mask in enumerate(turn_masks, 1)))
+    # and the per-granularity files of the original format
+    for granularity in GRANULARITIES:
         formatted_granularity = granularity.replace(" ", "_")
+        bit = GRANULARITY_BITS[granularity]
         with open(f"{GRANULARITY_RESULTS_DIR}/ground_truth_granularity={formatted_granularity}.jsonl", "w") as f:
-            for entry in granularity_data[granularity]:
-                f.write(json.dumps(entry) + "\n")
+            f.write("".join(json.dumps({"question_id": f"{image_id}_{turn_no}", "ground_truth": "Yes" if turn_mask & bit else "No"}) + "\n"
+                            for image_id, turn_masks in image_turn_masks for turn_no, turn_mask in enumerate(turn_masks, 1)))
+
+    # save the manifest for the next incremental run
+    with open(manifest_file, "w") as f:
+        json.dump(manifest, f)
@@ -0,0 +1,156 @@
+import os
+import sys
+import json
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from utils.live_evaluator import LiveEvaluator
+
+
+def parse_events(body):
+    # a JSON object, a JSON list of objects or JSON lines
+    body = body.strip()
+    if not body:
+        return []
+    if body.startswith("["):
+        return json.loads(body)
+    if "\n" not in body:
+        return [json.loads(body)]
+    return [json.loads(line) for line in body.splitlines() if line.strip()]
+
+
+def add_events(evaluator, events):
+    # adds the events one by one, reporting the invalid ones instead of stopping
+    accepted, closed, errors = 0, 0, []
+    for event in events:
+        try:
+            closed += evaluator.add_event(event)
+            accepted += 1
+        except (KeyError, ValueError, TypeError, AttributeError) as e:
+            errors.append({"event": event, "error": repr(e)})
+    return {"accepted": accepted, "closed_conversations": closed, "errors": errors}
+
+
+def make_handler(evaluator):
+    class LiveEvaluationHandler(BaseHTTPRequestHandler):
+        """
+        GET /metrics: current metrics.
+        GET /state: mergeable state of the evaluator.
+        POST /decisions: add decisions ({"question_id", "predicted"} objects, as a JSON object, list or JSON lines).
+        POST /close: close a conversation ({"image_id"}).
+        POST /merge: merge the state of another evaluator.
+        """
+
+        def send_json(self, status, data):
+            body = json.dumps(data).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/metrics":
+                self.send_json(200, evaluator.get_metrics())
+            elif self.path == "/state":
+                self.send_json(200, evaluator.get_state())
+            else:
+                self.send_json(404, {"error": f"Unknown path: {self.path}"})
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+            try:
+                if self.path == "/decisions":
+                    response = add_events(evaluator, parse_events(body))
+                    if response["closed_conversations"]:
+                        # keep the queries geocoded for the closed conversations
+                        evaluator.save_geocoding_cache()
+                    self.send_json(200, response)
+                elif self.path == "/close":
+                    evaluator.close_conversation(json.loads(body)["image_id"])
+                    evaluator.save_geocoding_cache()
+                    self.send_json(200, evaluator.get_metrics())
+                elif self.path == "/merge":
+                    evaluator.merge(json.loads(body))
+                    self.send_json(200, evaluator.get_metrics())
+                else:
+                    self.send_json(404, {"error": f"Unknown path: {self.path}"})
+            except (KeyError, ValueError) as e:
+                self.send_json(400, {"error": repr(e)})
+
+        def log_message(self, format, *args):
+            pass
+
+    return LiveEvaluationHandler
+
+
+def serve_stdin(evaluator):
+    # one event per line; {"command": "metrics"} prints the current metrics, as does the end of the input
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            event = json.loads(line)
+        except ValueError as e:
+            print(f"Invalid event: {e}", file=sys.stderr)
+            continue
+        if event.get("command") == "metrics":
+            print(json.dumps(evaluator.get_metrics()), flush=True)
+            continue
+        for error in add_events(evaluator, [event])["errors"]:
+            print(f"Invalid event {error['event']}: {error['error']}", file=sys.stderr)
+    print(json.dumps(evaluator.get_metrics()), flush=True)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="Host of the HTTP endpoint")
+    parser.add_argument("--port", type=int, default=8765,
+                        help="Port of the HTTP endpoint")
+    parser.add_argument("--stdin", action="store_true",
+                        help="Read decisions from stdin instead of serving HTTP")
+    parser.add_argument("--state_file", default=None,
+                        help="Resume from this state file and save the state to it on exit")
+    parser.add_argument("--geocoding_distance", action="store_true",
+                        help="Geocode each conversation when it closes")
+    parser.add_argument("--geocoder", choices=["geoapify", "gazetteer"], default="geoapify",
+                        help="Geocoder backend for the geocoding distance")
+    parser.add_argument("--gazetteer_file", default=None,
+                        help="GeoNames-style gazetteer file for the offline gazetteer geocoder")
+    args = parser.parse_args()
+
+    state = None
+    if args.state_file and os.path.exists(args.state_file):
+        with open(args.state_file, "r") as f:
+            state = json.load(f)
+    results_dir = "api_distance_responses"
+    if args.geocoding_distance:
+        from utils.geocoding_utils import configure_geocoder, configure_geocoding_cache
+        if args.geocoder == "gazetteer":
+            if args.gazetteer_file is None:
+                parser.error("--gazetteer_file is required with --geocoder gazetteer")
+            configure_geocoder("gazetteer", gazetteer_file=args.gazetteer_file)
+            results_dir = "api_distance_responses/gazetteer"
+            configure_geocoding_cache(cache_file=None, results_dir=results_dir)
+        else:
+            configure_geocoder()
+    evaluator = LiveEvaluator(geocoding_distance=args.geocoding_distance, state=state, results_dir=results_dir)
+
+    try:
+        if args.stdin:
+            serve_stdin(evaluator)
+        else:
+            server = ThreadingHTTPServer((args.host, args.port), make_handler(evaluator))
+            print(f"Serving live evaluation on http://{args.host}:{args.port}", flush=True)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            server.server_close()
+    finally:
+        evaluator.save_geocoding_cache()
+        if args.state_file:
+            tmp_file = f"{args.state_file}.tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(evaluator.get_state(), f)
+            os.replace(tmp_file, args.state_file)
@@ -0,0 +1,169 @@
+import os
+import json
+import mmap
+import math
+import struct
+
+# file layout (little-endian):
+#   header: magic, version, num_strings, num_images, num_turns, the sha256 of the annotations
+#       manifest the corpus was built from (zeros if none), then the byte offset of each section
+#   string_offsets: uint32[num_strings + 1] into the string blob (string 0 is "")
+#   image_string_ids: uint32[num_images], the interned image ids
+#   image_turn_offsets: uint32[num_images + 1] into the turn tables
+#   turn_string_ids: uint32[num_turns * 4], interned LOCATION_FIELDS of each turn
+#   turn_coordinates: float64[num_turns * 2], latitude/longitude of each turn (nan if not revealed)
+#   string_blob: utf-8 bytes of all interned strings
+MAGIC = b"GGCHAT"
+VERSION = 2
+HEADER = struct.Struct("<6sHIII32s6Q")
+LOCATION_FIELDS = ["country", "city", "neighborhood", "exact_location_name"]
+
+
+def _parse_coordinate(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def _align(offset, alignment=8):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def write_annotation_corpus(annotations_dir, output_file, manifest_hash=None):
+    """
+    Compiles the annotation_{image_id}.json files of a split into one packed corpus file.
+
+    manifest_hash is the sha256 (hex) of the annotations manifest written by
+    generate_ground_truths.py, so readers can tell when the corpus is out of date.
+
+    Returns the number of images written.
+    """
+    strings = {"": 0}
+    image_string_ids = []
+    image_turn_offsets = [0]
+    turn_string_ids = []
+    turn_coordinates = []
+
+    def intern(value):
+        # null fields are not revealed, like missing ones
+        value = "" if value is None else str(value)
+        if value not in strings:
+            strings[value] = len(strings)
+        return strings[value]
+
+    for filename in sorted(os.listdir(annotations_dir)):
+        if not filename.startswith("annotation_") or not filename.endswith(".json"):
+            continue
+        image_id = filename[len("annotation_"):-len(".json")]
+        with open(os.path.join(annotations_dir, filename), "r") as f:
+            messages = json.load(f)["messages"]
+        image_string_ids.append(intern(image_id))
+        for message in messages:
+            if message["role"] != "assistant":
+                continue
+            location_data = message.get("location_data", {})
+            turn_string_ids.extend(intern(location_data.get(field, ""))
+                                   for field in LOCATION_FIELDS)
+            turn_coordinates.append(_parse_coordinate(location_data.get("latitude", "")))
+            turn_coordinates.append(_parse_coordinate(location_data.get("longitude", "")))
+        image_turn_offsets.append(len(turn_string_ids) // len(LOCATION_FIELDS))
+
+    encoded_strings = [value.encode("utf-8") for value in strings]
+    string_offsets = [0]
+    for encoded in encoded_strings:
+        string_offsets.append(string_offsets[-1] + len(encoded))
+
+    sections = [
+        struct.pack(f"<{len(string_offsets)}I", *string_offsets),
+        struct.pack(f"<{len(image_string_ids)}I", *image_string_ids),
+        struct.pack(f"<{len(image_turn_offsets)}I", *image_turn_offsets),
+        struct.pack(f"<{len(turn_string_ids)}I", *turn_string_ids),
+        struct.pack(f"<{len(turn_coordinates)}d", *turn_coordinates),
+        b"".join(encoded_strings),
+    ]
+    section_offsets = []
+    offset = HEADER.size
+    for section in sections:
+        offset = _align(offset)
+        section_offsets.append(offset)
+        offset += len(section)
+
+    tmp_file = f"{output_file}.tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(strings), len(image_string_ids), len(turn_coordinates) // 2,
+                            bytes.fromhex(manifest_hash) if manifest_hash else bytes(32), *section_offsets))
+        for section, section_offset in zip(sections, section_offsets):
+            f.write(b"\0" * (section_offset - f.tell()))
+            f.write(section)
+    os.replace(tmp_file, output_file)
+    return len(image_string_ids)
+
+
+class AnnotationCorpus:
+    """
+    Read-only, memory-mapped view of a corpus written by write_annotation_corpus.
+
+    The integer and float tables are zero-copy memoryviews over the mapped file; only the
+    image id index is materialized when the corpus is opened.
+    """
+
+    def __init__(self, corpus_file):
+        self.corpus_file = corpus_file
+        with open(corpus_file, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buffer = buffer = memoryview(self.mmap)
+        if len(buffer) < HEADER.size or buffer[:len(MAGIC)] != MAGIC or \
+                struct.unpack_from("<H", buffer, len(MAGIC))[0] != VERSION:
+            buffer.release()
+            self.mmap.close()
+            raise ValueError(f"Not an annotation corpus of version {VERSION}: {corpus_file}")
+        (_, _, num_strings, num_images, num_turns, manifest_hash, string_offsets_start,
+         image_string_ids_start, image_turn_offsets_start, turn_string_ids_start,
+         turn_coordinates_start, string_blob_start) = HEADER.unpack_from(buffer)
+        # sha256 of the annotations manifest the corpus was built from, None if unknown
+        self.manifest_hash = None if manifest_hash == bytes(32) else manifest_hash.hex()
+
+        def view(start, count, fmt):
+            itemsize = struct.calcsize(fmt)
+            return buffer[start:start + count * itemsize].cast(fmt)
+
+        self.string_offsets = view(string_offsets_start, num_strings + 1, "I")
+        self.image_string_ids = view(image_string_ids_start, num_images, "I")
+        self.image_turn_offsets = view(image_turn_offsets_start, num_images + 1, "I")
+        self.turn_string_ids = view(
+            turn_string_ids_start, num_turns * len(LOCATION_FIELDS), "I")
+        self.turn_coordinates = view(turn_coordinates_start, num_turns * 2, "d")
+        self.string_blob = buffer[string_blob_start:string_blob_start + self.string_offsets[num_strings]]
+        self.image_index = {self.get_string(string_id): idx for idx,
+                            string_id in enumerate(self.image_string_ids)}
+
+    def __contains__(self, image_id):
+        return image_id in self.image_index
+
+    def __len__(self):
+        return len(self.image_index)
+
+    def get_string(self, string_id):
+        return str(self.string_blob[self.string_offsets[string_id]:self.string_offsets[string_id + 1]], "utf-8")
+
+    def get_turn_range(self, image_id):
+        idx = self.image_index[image_id]
+        return self.image_turn_offsets[idx], self.image_turn_offsets[idx + 1]
+
+    def get_turn_location_data(self, image_id):
+        # location data of every assistant turn, with "" for fields that are not revealed
+        start, end = self.get_turn_range(image_id)
+        num_fields = len(LOCATION_FIELDS)
+        return [{field: self.get_string(self.turn_string_ids[turn * num_fields + field_idx])
+                 for field_idx, field in enumerate(LOCATION_FIELDS)} for turn in range(start, end)]
+
+    def get_turn_coordinates(self, image_id):
+        start, end = self.get_turn_range(image_id)
+        return [(self.turn_coordinates[2 * turn], self.turn_coordinates[2 * turn + 1]) for turn in range(start, end)]
+
+    def close(self):
+        for name in ("string_offsets", "image_string_ids", "image_turn_offsets",
+                     "turn_string_ids", "turn_coordinates", "string_blob", "buffer"):
+            getattr(self, name).release()
+        self.mmap.close()
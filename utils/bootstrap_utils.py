@@ -0,0 +1,136 @@
+import numpy as np
+
+
+def binary_scores(tp, fp, fn):
+    """
+    Computes recall, precision and F1 from (arrays of) confusion counts.
+
+    Undefined scores are set to 0, matching sklearn's precision_recall_fscore_support.
+    """
+    tp, fp, fn = (np.asarray(count, dtype=np.float64) for count in (tp, fp, fn))
+
+    def safe_divide(numerator, denominator):
+        return np.divide(numerator, denominator, out=np.zeros_like(numerator), where=denominator > 0)
+
+    recall = safe_divide(tp, tp + fn)
+    precision = safe_divide(tp, tp + fp)
+    f1 = safe_divide(2 * tp, 2 * tp + fp + fn)
+    return recall, precision, f1
+
+
+def bootstrap_binary_metrics(predictions, ground_truths, num_bootstrap_samples=500, sample_size=750, seed=None, confidence_level=0.95):
+    """
+    Bootstraps recall, precision and F1 for binary predictions.
+
+    All resamples are drawn at once as a (num_bootstrap_samples, sample_size) index matrix and the
+    confusion counts of every resample are computed with a few array operations.
+
+    Args:
+        predictions: boolean array of predictions.
+        ground_truths: boolean array of ground truths.
+        num_bootstrap_samples: number of resamples.
+        sample_size: size of each resample (capped at the number of predictions).
+        seed: seed for the NumPy random generator.
+        confidence_level: coverage of the percentile confidence intervals.
+
+    Returns:
+        A dict mapping each metric to its mean, std and percentile confidence interval.
+    """
+    predictions = np.asarray(predictions, dtype=bool)
+    ground_truths = np.asarray(ground_truths, dtype=bool)
+    rng = np.random.default_rng(seed)
+    sample_size = min(sample_size, len(predictions))
+    indices = rng.integers(0, len(predictions), size=(
+        num_bootstrap_samples, sample_size))
+    # encode each prediction as 0: TN, 1: FP, 2: FN, 3: TP
+    outcomes = (predictions.astype(np.int8) + 2 * ground_truths.astype(np.int8))[indices]
+    tp = (outcomes == 3).sum(axis=1)
+    fp = (outcomes == 1).sum(axis=1)
+    fn = (outcomes == 2).sum(axis=1)
+    return summarize_bootstrap_scores(tp, fp, fn, confidence_level)
+
+
+def summarize_bootstrap_scores(tp, fp, fn, confidence_level=0.95, scale=1.0):
+    # mean, std and percentile confidence interval of the scores of the resamples, whose
+    # deviations from their mean are multiplied by scale
+    recall, precision, f1 = binary_scores(tp, fp, fn)
+    lower_percentile = (1 - confidence_level) / 2 * 100
+    results = {}
+    for metric, scores in (("recall", recall), ("precision", precision), ("f1", f1)):
+        if scale != 1.0:
+            scores = np.mean(scores) + (scores - np.mean(scores)) * scale
+        results[metric] = {"mean": float(np.mean(scores)), "std": float(np.std(scores)),
+                           "ci_lower": float(np.percentile(scores, lower_percentile)),
+                           "ci_upper": float(np.percentile(scores, 100 - lower_percentile))}
+    return results
+
+
+def bootstrap_confusion_counts(confusion_counts, num_bootstrap_samples=500, sample_size=750, seed=None, confidence_level=0.95):
+    """
+    Bootstraps recall, precision and F1 from pooled confusion counts.
+
+    A resample of the predictions only depends on how many of its draws are TN, FP, FN and TP,
+    which is multinomial in the pooled counts. So the counts are sufficient statistics: the
+    results follow the same distribution as bootstrap_binary_metrics on the predictions (though
+    not the same draws for a given seed), and counts from disjoint shards can simply be added.
+
+    Args:
+        confusion_counts: the [tn, fp, fn, tp] counts.
+
+    Returns:
+        The same dict as bootstrap_binary_metrics.
+    """
+    confusion_counts = np.asarray(confusion_counts, dtype=np.int64)
+    if confusion_counts.sum() == 0:
+        # no predictions (e.g. an empty shard): every score is undefined, so 0 as in confusion_scores
+        no_counts = np.zeros(num_bootstrap_samples, dtype=np.int64)
+        return summarize_bootstrap_scores(no_counts, no_counts, no_counts, confidence_level)
+    rng = np.random.default_rng(seed)
+    sample_size = min(sample_size, int(confusion_counts.sum()))
+    _, fp, fn, tp = rng.multinomial(sample_size, confusion_counts / confusion_counts.sum(), size=num_bootstrap_samples).T
+    return summarize_bootstrap_scores(tp, fp, fn, confidence_level)
+
+
+class OnlinePoissonBootstrap:
+    """
+    Bootstraps recall, precision and F1 in one pass over a stream of predictions, in constant
+    memory.
+
+    Each prediction gets an independent Poisson(1) weight in each of the num_bootstrap_samples
+    replicates, which approximates resampling the whole stream with replacement without knowing
+    its length. The scores only depend on the weighted [tn, fp, fn, tp] counts of each replicate
+    and a sum of k Poisson(1) weights is Poisson(k), so only the four outcome counts are kept
+    and the weighted counts of every replicate are drawn at once in result.
+    """
+
+    def __init__(self, num_bootstrap_samples=500, seed=None):
+        self.num_bootstrap_samples = num_bootstrap_samples
+        self.seed = seed
+        # outcomes counted as 0: TN, 1: FP, 2: FN, 3: TP
+        self.counts = [0, 0, 0, 0]
+
+    @property
+    def num_predictions(self):
+        return sum(self.counts)
+
+    def add(self, prediction, ground_truth):
+        self.counts[int(prediction) + 2 * int(ground_truth)] += 1
+
+    def result(self, sample_size=None, confidence_level=0.95):
+        """
+        Args:
+            sample_size: if smaller than the number of predictions, the spread of the scores is
+                scaled to resamples of sample_size predictions (by sqrt(n / sample_size)), to
+                match bootstrap_binary_metrics with the same sample_size.
+            confidence_level: coverage of the percentile confidence intervals.
+
+        Returns:
+            The same dict as bootstrap_binary_metrics.
+        """
+        num_predictions = self.num_predictions
+        scale = 1.0
+        if sample_size is not None and 0 < sample_size < num_predictions:
+            scale = float(np.sqrt(num_predictions / sample_size))
+        weighted_counts = np.random.default_rng(self.seed).poisson(self.counts, size=(self.num_bootstrap_samples, 4))
+        _, fp, fn, tp = weighted_counts.T
+        return summarize_bootstrap_scores(tp, fp, fn, confidence_level, scale)
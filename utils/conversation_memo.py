@@ -0,0 +1,154 @@
+import os
+import sys
+import pickle
+import threading
+from utils import profiling
+from utils.metrics_cache import hash_file, get_ground_truth_version
+
+# bump when a change to the memoized functions invalidates previously saved entries
+CONVERSATION_MEMO_VERSION = 1
+CONVERSATION_MEMO_FILE = ".conversation_memo/conversation_memo.pkl"
+# revealed: revealed location data of a conversation
+# results: withheld/leaked result of a conversation at one granularity, for the per-file path
+#   (compute_withheld_leaked, sharded runs); unsharded runs compute every agent at once in
+#   utils.privacy_tensor and do not use it
+# distances: geocoding result of a conversation with one geocoder
+MEMO_TABLES = ("revealed", "results", "distances")
+
+# memo shared by every agent and granularity in the process
+_conversation_memo = None
+
+
+def get_conversation_key(image_id, include_turn):
+    """
+    Key of a conversation: its image, number of turns and the bitmask of its included (not
+    moderated) turns, bit i for turn i + 1. Agents with the same decisions on an image share it.
+    """
+    mask = 0
+    for turn_idx, include in enumerate(include_turn):
+        if include:
+            mask |= 1 << turn_idx
+    return image_id, len(include_turn), mask
+
+
+def get_memo_version(ground_truth_dir="moderation_decisions_ground_truth"):
+    # everything the memoized results depend on besides the conversation itself
+    return {"version": CONVERSATION_MEMO_VERSION, "ground_truth": get_ground_truth_version(ground_truth_dir),
+            "annotations": hash_file("gptgeochat/human/ground_truth_results/manifest.json"),
+            "location_data": hash_file("ground_truth_location_data.json")}
+
+
+class ConversationMemo:
+    """
+    Memo of per-conversation results keyed by get_conversation_key, shared across agents and
+    granularities. The revealed location data and the geocoding distance of a conversation do
+    not depend on the granularity, so they are reused by every agent with the same mask.
+
+    Hits and misses are counted per table. The memo can be shared by threads and, with a
+    memo_file, saved for later runs; a saved memo is only loaded if it has the same version (and
+    is ignored if it cannot be read). Worker processes record what they add with start_delta and
+    send it back to the main process, which merges it (see utils.scheduler).
+    """
+
+    def __init__(self, memo_file=None, version=None):
+        self.memo_file = memo_file
+        self.version = version
+        self.tables = {table: {} for table in MEMO_TABLES}
+        self.hits = {table: 0 for table in MEMO_TABLES}
+        self.misses = {table: 0 for table in MEMO_TABLES}
+        self.dirty = False
+        # entries and counts added since start_delta, None when not recording
+        self.delta = None
+        self.lock = threading.Lock()
+        if memo_file and os.path.exists(memo_file):
+            try:
+                with open(memo_file, "rb") as f:
+                    saved = pickle.load(f)
+                if saved["version"] == version:
+                    self.tables.update({table: dict(saved["tables"][table]) for table in MEMO_TABLES})
+            except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, IndexError, KeyError, TypeError, ValueError) as e:
+                print(f"Ignoring the conversation memo {memo_file}, it cannot be read: {e!r}", file=sys.stderr)
+
+    def get(self, table, key):
+        with self.lock:
+            value = self.tables[table].get(key)
+            counts = self.misses if value is None else self.hits
+            counts[table] += 1
+            if self.delta is not None:
+                self.delta["misses" if value is None else "hits"][table] += 1
+        profiling.count(f"conversation_memo_{table}_{'misses' if value is None else 'hits'}")
+        return value
+
+    def put(self, table, key, value):
+        with self.lock:
+            self.tables[table][key] = value
+            self.dirty = True
+            if self.delta is not None:
+                self.delta["tables"][table][key] = value
+
+    def get_or_compute(self, table, key, compute):
+        value = self.get(table, key)
+        if value is None:
+            value = compute()
+            self.put(table, key, value)
+        return value
+
+    def start_delta(self):
+        # starts recording the entries added and the hits and misses, see take_delta
+        with self.lock:
+            self.delta = {"tables": {table: {} for table in MEMO_TABLES},
+                          "hits": {table: 0 for table in MEMO_TABLES}, "misses": {table: 0 for table in MEMO_TABLES}}
+
+    def take_delta(self):
+        # returns what was recorded since start_delta and stops recording
+        with self.lock:
+            delta, self.delta = self.delta, None
+        return delta
+
+    def merge(self, delta):
+        # adds the entries and counts of another memo's take_delta
+        if delta is None:
+            return
+        with self.lock:
+            for table in MEMO_TABLES:
+                if delta["tables"][table]:
+                    self.tables[table].update(delta["tables"][table])
+                    self.dirty = True
+                self.hits[table] += delta["hits"][table]
+                self.misses[table] += delta["misses"][table]
+
+    def stats(self):
+        stats = {}
+        for table in MEMO_TABLES:
+            total = self.hits[table] + self.misses[table]
+            stats[table] = {"entries": len(self.tables[table]), "hits": self.hits[table], "misses": self.misses[table],
+                            "hit_rate": self.hits[table] / total if total else 0.0}
+        return stats
+
+    def save(self):
+        if not self.memo_file or not self.dirty:
+            return
+        directory = os.path.dirname(self.memo_file)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with self.lock:
+            tmp_file = f"{self.memo_file}.{os.getpid()}.tmp"
+            with open(tmp_file, "wb") as f:
+                pickle.dump({"version": self.version, "tables": self.tables}, f)
+            os.replace(tmp_file, self.memo_file)
+            self.dirty = False
+
+
+def configure_conversation_memo(memo_file=None, version=None):
+    # memo_file=None keeps the memo in memory for this run only
+    global _conversation_memo
+    if memo_file is not None and version is None:
+        version = get_memo_version()
+    _conversation_memo = ConversationMemo(memo_file, version)
+    return _conversation_memo
+
+
+def get_conversation_memo():
+    if _conversation_memo is None:
+        configure_conversation_memo()
+    return _conversation_memo
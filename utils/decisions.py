@@ -0,0 +1,222 @@
+import os
+import json
+import struct
+import hashlib
+from array import array
+from utils import profiling
+from utils.metrics_cache import hash_file
+
+DECISIONS_CACHE_DIR = ".decisions_cache"
+# sidecar layout (native byte order, the sidecars are a local cache):
+#   header: magic, version, size, mtime and sha256 of the decisions file, num_lines, num_conversations, image_ids_size
+#   image_indices: uint32[num_lines], index of the image of each line in image_ids
+#   turn_numbers: uint32[num_lines]
+#   moderated: uint8[num_lines], 1 if the agent moderated the turn ("Yes")
+#   line_offsets: int64[num_lines], byte offset of each line in the decisions file (to load rationales)
+#   conversation_offsets: int64[num_conversations + 1] into the line arrays
+#   image_ids: utf-8 image ids joined by "\n"
+MAGIC = b"GGDECS"
+VERSION = 1
+HEADER = struct.Struct("<6sHQQ32sQQQ")
+PREDICTIONS = {"Yes": 1, "No": 0}
+
+# decisions loaded by this process (and inherited by forked workers), keyed on the path, size
+# and mtime of their file, so each file is read once per run
+_loaded_decisions = {}
+
+
+def parse_decision(question_id, predicted):
+    """
+    Parses one decision: its question id "{image_id}_{turn_no}" and its prediction, read
+    case-insensitively, which must be "Yes" or "No".
+
+    Returns:
+        The image id, the turn number and the moderated flag (1 for "Yes").
+    """
+    image_id, turn_no = question_id.rsplit("_", 1)
+    moderated = PREDICTIONS.get(predicted.capitalize())
+    if moderated is None:
+        raise ValueError(f"Invalid prediction for {question_id}: {predicted}")
+    return image_id, int(turn_no), moderated
+
+
+class ModerationDecisions:
+    """
+    The moderation decisions of one agent, stored column-wise.
+
+    Each line of the decisions file is an image index (into the interned image_ids), a turn
+    number and a moderated flag. Consecutive lines with the same image form one conversation,
+    conversation i owning lines conversation_offsets[i]:conversation_offsets[i + 1]. Rationales
+    are not kept in memory, they are read from the decisions file on request.
+    """
+
+    def __init__(self, image_ids, image_indices, turn_numbers, moderated, line_offsets, conversation_offsets, source_file=None, records=None):
+        self.image_ids = image_ids
+        self.image_indices = image_indices
+        self.turn_numbers = turn_numbers
+        self.moderated = moderated
+        self.line_offsets = line_offsets
+        self.conversation_offsets = conversation_offsets
+        self.source_file = source_file
+        self.records = records
+
+    @classmethod
+    def from_records(cls, records, source_file=None, line_offsets=None):
+        """
+        Builds the decisions from parsed lines (dicts with question_id and predicted), see
+        parse_decision.
+        """
+        if source_file is None:
+            records = list(records)
+        image_index = {}
+        image_ids = []
+        image_indices = array('I')
+        turn_numbers = array('I')
+        moderated = array('B')
+        conversation_offsets = array('q', [0])
+        for line_idx, record in enumerate(records):
+            image_id, turn_no, line_moderated = parse_decision(record["question_id"], record["predicted"])
+            if image_id not in image_index:
+                image_index[image_id] = len(image_ids)
+                image_ids.append(image_id)
+            if line_idx > 0 and image_indices[-1] != image_index[image_id]:
+                conversation_offsets.append(line_idx)
+            image_indices.append(image_index[image_id])
+            turn_numbers.append(turn_no)
+            moderated.append(line_moderated)
+        if len(image_indices) > 0:
+            conversation_offsets.append(len(image_indices))
+        return cls(image_ids, image_indices, turn_numbers, moderated, line_offsets or array('q'),
+                   conversation_offsets, source_file, None if source_file else records)
+
+    def __len__(self):
+        return len(self.image_indices)
+
+    @property
+    def num_conversations(self):
+        return len(self.conversation_offsets) - 1
+
+    def get_question_id(self, line_idx):
+        return f"{self.image_ids[self.image_indices[line_idx]]}_{self.turn_numbers[line_idx]}"
+
+    def get_rationale(self, line_idx):
+        # rationale of a line (None if the agent gives none), read from the decisions file
+        if self.records is not None:
+            return self.records[line_idx].get("rationale")
+        with open(self.source_file, "rb") as f:
+            f.seek(self.line_offsets[line_idx])
+            record = json.loads(f.readline())
+        if record["question_id"] != self.get_question_id(line_idx):
+            raise ValueError(f"{self.source_file} changed since its decisions were loaded")
+        return record.get("rationale")
+
+    def iter_conversations(self):
+        """
+        Yields:
+            Tuples (image_id, turn_numbers, moderated) for each conversation, in file order.
+        """
+        offsets = self.conversation_offsets
+        for conversation_idx in range(len(offsets) - 1):
+            start, end = offsets[conversation_idx], offsets[conversation_idx + 1]
+            yield self.image_ids[self.image_indices[start]], self.turn_numbers[start:end], self.moderated[start:end]
+
+
+def parse_decisions_file(answers_file):
+    records = []
+    line_offsets = array('q')
+    with open(answers_file, "rb") as f:
+        offset = 0
+        for line in f:
+            if line.strip():
+                records.append(json.loads(line))
+                line_offsets.append(offset)
+            offset += len(line)
+        profiling.count_file_read(f, len(records))
+    return ModerationDecisions.from_records(records, source_file=answers_file, line_offsets=line_offsets)
+
+
+def get_sidecar_file(answers_file, cache_dir=DECISIONS_CACHE_DIR):
+    # one sidecar per decisions file, named after its path
+    path_hash = hashlib.sha1(os.path.abspath(answers_file).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{os.path.basename(answers_file)}.{path_hash}.bin")
+
+
+def write_sidecar(decisions, sidecar_file, source_stat, source_hash):
+    image_ids = "\n".join(decisions.image_ids).encode("utf-8")
+    directory = os.path.dirname(sidecar_file)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    # workers may write the same sidecar, so write to a private file and rename it
+    tmp_file = f"{sidecar_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, source_stat.st_size, source_stat.st_mtime_ns, source_hash,
+                            len(decisions), decisions.num_conversations, len(image_ids)))
+        for column in (decisions.image_indices, decisions.turn_numbers, decisions.moderated,
+                       decisions.line_offsets, decisions.conversation_offsets):
+            column.tofile(f)
+        f.write(image_ids)
+    os.replace(tmp_file, sidecar_file)
+
+
+def read_sidecar(sidecar_file, answers_file, source_stat):
+    """
+    Loads the decisions of answers_file from its sidecar.
+
+    The sidecar is used if it was written for a file with the same size and mtime, or the same
+    content hash (e.g. after a checkout that only touched the file). Returns None otherwise.
+    """
+    if not os.path.exists(sidecar_file):
+        return None
+    with open(sidecar_file, "rb") as f:
+        data = f.read()
+        profiling.count_file_read(f)
+    if len(data) < HEADER.size:
+        return None
+    magic, version, size, mtime_ns, source_hash, num_lines, num_conversations, image_ids_size = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION or size != source_stat.st_size:
+        return None
+    if mtime_ns != source_stat.st_mtime_ns and source_hash != bytes.fromhex(hash_file(answers_file)):
+        return None
+
+    columns = []
+    offset = HEADER.size
+    for typecode, length in (('I', num_lines), ('I', num_lines), ('B', num_lines), ('q', num_lines), ('q', num_conversations + 1)):
+        column = array(typecode)
+        column.frombytes(data[offset:offset + length * column.itemsize])
+        offset += length * column.itemsize
+        columns.append(column)
+    image_ids = data[offset:offset + image_ids_size].decode("utf-8").split("\n") if image_ids_size else []
+    decisions = ModerationDecisions(image_ids, *columns, source_file=answers_file)
+    if mtime_ns != source_stat.st_mtime_ns:
+        # same content with a new mtime: refresh the sidecar so the next load skips the hash
+        write_sidecar(decisions, sidecar_file, source_stat, source_hash)
+    return decisions
+
+
+def load_decisions(answers_file, cache_dir=DECISIONS_CACHE_DIR):
+    """
+    Loads the moderation decisions of a decisions file, from its binary sidecar in cache_dir
+    when it is up to date. Otherwise the file is parsed and its sidecar (re)written. Files
+    already loaded by the process are not read again.
+
+    Args:
+        answers_file: path of the moderation decisions file.
+        cache_dir: directory of the sidecars, or None to always parse the file.
+
+    Returns:
+        The ModerationDecisions of the file.
+    """
+    if cache_dir is None:
+        return parse_decisions_file(answers_file)
+    source_stat = os.stat(answers_file)
+    memo_key = (os.path.abspath(answers_file), source_stat.st_size, source_stat.st_mtime_ns)
+    if memo_key in _loaded_decisions:
+        profiling.count("decisions_memo_hits")
+        return _loaded_decisions[memo_key]
+    sidecar_file = get_sidecar_file(answers_file, cache_dir)
+    decisions = read_sidecar(sidecar_file, answers_file, source_stat)
+    if decisions is None:
+        decisions = parse_decisions_file(answers_file)
+        write_sidecar(decisions, sidecar_file, source_stat, bytes.fromhex(hash_file(answers_file)))
+    _loaded_decisions[memo_key] = decisions
+    return decisions
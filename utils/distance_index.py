@@ -0,0 +1,160 @@
+import os
+import numpy as np
+from utils import profiling
+from utils.geodesy import DISTANCE_THRESHOLDS
+
+# bump when the layout of the saved indexes changes
+DISTANCE_INDEX_VERSION = 1
+DISTANCE_INDEX_DIR = "distance_index"
+# distance saved for conversations where nothing revealed could be geocoded
+UNRESOLVED_DISTANCE = 999999999
+# GeoGuessr scores a guess 5000 * exp(-distance / 1492.7 km)
+GEOSCORE_SCALE = 1492.7
+GEOSCORE_MAX = 5000
+
+
+class DistanceIndex:
+    """
+    Sorted geocoding distances of one agent, answering threshold, CDF, AUC and GeoScore queries
+    without going back to the conversations.
+
+    Unresolved conversations (UNRESOLVED_DISTANCE) are kept as a count rather than in the
+    sorted array; they count in every denominator and are never within a threshold. Prefix sums
+    of the log distances and of the GeoScores are built on load, so every query is a binary
+    search plus O(1) arithmetic.
+    """
+
+    def __init__(self, distances, num_unresolved=0):
+        self.distances = np.sort(np.asarray(distances, dtype=np.float64))
+        self.num_unresolved = int(num_unresolved)
+        # prefix sums over the sorted distances, with a leading 0
+        self.log_prefix = np.concatenate([[0.0], np.cumsum(np.log(np.maximum(self.distances, np.finfo(np.float64).tiny)))])
+        self.geoscore_prefix = np.concatenate([[0.0], np.cumsum(np.exp(-self.distances / GEOSCORE_SCALE))])
+
+    @classmethod
+    def from_distances(cls, distances):
+        distances = np.asarray(distances, dtype=np.float64)
+        unresolved = distances >= UNRESOLVED_DISTANCE
+        return cls(distances[~unresolved], np.count_nonzero(unresolved))
+
+    def __len__(self):
+        # every conversation with ground truth coordinates, resolved or not
+        return len(self.distances) + self.num_unresolved
+
+    def count_within(self, thresholds):
+        """
+        Returns:
+            A dict mapping each threshold to the number of distances <= it, plus "all" for the
+            number of distances, as returned by compute_api_distance.
+        """
+        counts = np.searchsorted(self.distances, np.asarray(thresholds, dtype=np.float64), side="right")
+        distance_thresholds = {threshold: int(count) + (self.num_unresolved if threshold >= UNRESOLVED_DISTANCE else 0)
+                               for threshold, count in zip(thresholds, counts)}
+        distance_thresholds["all"] = len(self)
+        return distance_thresholds
+
+    def cdf(self, distances=None):
+        """
+        Proportion of conversations within each distance. Without distances, returns the full
+        step function: the sorted distances and the proportion within each of them.
+        """
+        if len(self) == 0:
+            return (self.distances, np.zeros(0)) if distances is None else np.zeros(len(distances))
+        if distances is None:
+            return self.distances, np.arange(1, len(self.distances) + 1) / len(self)
+        return np.searchsorted(self.distances, np.asarray(distances, dtype=np.float64), side="right") / len(self)
+
+    def quantile(self, q):
+        # nearest-rank quantile, inf if it falls among the unresolved conversations
+        rank = int(np.ceil(q * len(self))) - 1
+        if len(self) == 0 or rank >= len(self.distances):
+            return float("inf")
+        return float(self.distances[max(rank, 0)])
+
+    def auc(self, min_distance=DISTANCE_THRESHOLDS[0], max_distance=DISTANCE_THRESHOLDS[-1]):
+        """
+        Area under the accuracy-vs-distance curve (the CDF) on a log distance axis from
+        min_distance to max_distance, normalized to [0, 1]: 1 if every guess is within
+        min_distance, 0 if none is within max_distance.
+        """
+        if len(self) == 0:
+            return 0.0
+        log_min, log_max = np.log(min_distance), np.log(max_distance)
+        # each distance d <= max_distance contributes log(max_distance) - log(max(d, min_distance))
+        num_below, num_within = np.searchsorted(self.distances, [min_distance, max_distance], side="right")
+        area = num_below * (log_max - log_min) + (num_within - num_below) * log_max - (self.log_prefix[num_within] - self.log_prefix[num_below])
+        return float(area / (len(self) * (log_max - log_min)))
+
+    def geoscore(self, scale=GEOSCORE_SCALE, max_score=GEOSCORE_MAX):
+        """
+        Mean GeoGuessr-style score, max_score * exp(-distance / scale), with unresolved
+        conversations scoring 0. Only the default scale is precomputed.
+        """
+        if len(self) == 0:
+            return 0.0
+        if scale == GEOSCORE_SCALE:
+            total = self.geoscore_prefix[-1]
+        else:
+            total = np.exp(-self.distances / scale).sum()
+        return float(max_score * total / len(self))
+
+    def summary(self, thresholds=DISTANCE_THRESHOLDS):
+        distance_thresholds = self.count_within(thresholds)
+        return {"all": len(self), "unresolved": self.num_unresolved,
+                "within": {threshold: distance_thresholds[threshold] / len(self) if len(self) else 0.0 for threshold in thresholds},
+                "median": self.quantile(0.5), "auc": self.auc(), "geoscore": self.geoscore()}
+
+    def save(self, index_file):
+        directory = os.path.dirname(index_file)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        tmp_file = f"{index_file}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_file, version=DISTANCE_INDEX_VERSION, distances=self.distances, num_unresolved=self.num_unresolved)
+        os.replace(tmp_file, index_file)
+
+    @classmethod
+    def load(cls, index_file):
+        with np.load(index_file) as saved:
+            if int(saved["version"]) != DISTANCE_INDEX_VERSION:
+                raise ValueError(f"{index_file} was written with distance index version {int(saved['version'])}")
+            index = cls(saved["distances"], int(saved["num_unresolved"]))
+        profiling.count("distance_index_loads")
+        return index
+
+
+def get_distance_index_file(results_dir, model):
+    return os.path.join(results_dir, DISTANCE_INDEX_DIR, f"{model}.npz")
+
+
+def save_distance_indexes(results_dir, model_distances):
+    """
+    Saves the distance index of each agent (model name including the granularity, as in
+    generate_eval_metrics.py) from its geocoding distances.
+    """
+    indexes = {}
+    for model, distances in model_distances.items():
+        indexes[model] = DistanceIndex.from_distances(distances)
+        indexes[model].save(get_distance_index_file(results_dir, model))
+    return indexes
+
+
+def load_distance_indexes(results_dir, models):
+    """
+    Raises:
+        ValueError if an agent has no saved index.
+
+    Returns:
+        A dict mapping each agent to its DistanceIndex.
+    """
+    indexes = {}
+    for model in models:
+        index_file = get_distance_index_file(results_dir, model)
+        if not os.path.exists(index_file):
+            raise ValueError(f"No distance index for {model} in {os.path.dirname(index_file)}, run --geocoding_distance first")
+        indexes[model] = DistanceIndex.load(index_file)
+    return indexes
+
+
+def count_within_all(indexes, thresholds):
+    # threshold counts of every agent, as returned by compute_api_distance
+    return {model: index.count_within(thresholds) for model, index in indexes.items()}
@@ -81,3 +81,27 @@ def print_table(table_title, granularity_results, column_display_names, column_k
 
         print("=" * (sum(column_widths) + len(column_widths) - 1))
         print()
+
+
+def print_distribution_table(table_title, granularity_distributions, percentiles, column_widths=(30, 12, 12, 40)):
+    # Print table title
+    width = sum(column_widths) + len(column_widths) - 1
+    print("=" * width)
+    print(table_title)
+    print("=" * width)
+    percentile_names = ", ".join(f"p{percentile:g}" for percentile in percentiles)
+    for granularity, distributions in granularity_distributions.items():
+        print("=" * width)
+        print(f"Granularity: {GRANULARITY_DISPLAY_NAMES[granularity]}")
+        print("=" * width)
+        for display_name, column_width in zip(['Metric', 'Mean', 'Std', f'[{percentile_names}]'], column_widths):
+            print(f"{display_name:<{column_width}}", end=' ')
+        print()
+        print("=" * width)
+        for metric, distribution in distributions.items():
+            values = ", ".join(f"{distribution['percentiles'][percentile]:.3f}" for percentile in percentiles)
+            for value, column_width in zip([metric, f"{distribution['mean']:.3f}", f"{distribution['std']:.3f}", f"[{values}]"], column_widths):
+                print(f"{value:<{column_width}}", end=' ')
+            print()
+        print("=" * width)
+        print()
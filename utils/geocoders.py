@@ -0,0 +1,159 @@
+import math
+from array import array
+from utils.geocoding_client import GeocodingClient
+from utils.geocoding_cache import normalize_query_params
+
+# GeoNames feature codes of countries and of sections of populated places (neighborhoods)
+COUNTRY_FEATURE_CODES = {"PCL", "PCLD", "PCLF", "PCLI", "PCLIX", "PCLS", "TERR"}
+NEIGHBORHOOD_FEATURE_CODES = {"PPLX"}
+# neighborhoods and exact locations are searched within this distance of the matched city
+CITY_RADIUS_KM = 50
+
+
+class GeocoderBackend:
+    """
+    Resolves geocoding queries (the params returned by get_query_params) to guessed points.
+
+    geocode_many returns a (points, confidences) tuple for each query, in query order, with
+    points as (latitude, longitude) tuples and confidences in [0, 1]. iter_geocode yields lists
+    of (query index, result) pairs as the queries are resolved, with None as the result of a
+    failed request; backends that resolve a batch at once yield it as a single list.
+    """
+    name = None
+
+    def geocode_many(self, queries):
+        raise NotImplementedError
+
+    def iter_geocode(self, queries):
+        yield list(enumerate(self.geocode_many(queries)))
+
+    def close(self):
+        pass
+
+
+class GeoapifyBackend(GeocoderBackend):
+    name = "geoapify"
+
+    def __init__(self, **client_kwargs):
+        self.client = GeocodingClient(**client_kwargs)
+
+    def geocode_many(self, queries):
+        return self.client.geocode_many(queries)
+
+    def iter_geocode(self, queries):
+        return self.client.iter_geocode(queries)
+
+    def close(self):
+        self.client.close()
+
+
+def _normalize_name(name):
+    return normalize_query_params({"name": name}).get("name", "")
+
+
+def _approximate_distance_km(latitude1, longitude1, latitude2, longitude2):
+    # equirectangular approximation, accurate enough to filter candidates by CITY_RADIUS_KM
+    x = math.radians(longitude2 - longitude1) * math.cos(math.radians((latitude1 + latitude2) / 2))
+    y = math.radians(latitude2 - latitude1)
+    return 6371.0 * math.hypot(x, y)
+
+
+class GazetteerBackend(GeocoderBackend):
+    """
+    Offline geocoder over a GeoNames-style gazetteer (tab-separated, with the columns of the
+    GeoNames geoname table: geonameid, name, asciiname, alternatenames, latitude, longitude,
+    feature class, feature code, country code, ..., population, ...).
+
+    Places are indexed by their normalized names. Countries (PCL* features) map country names
+    to country codes, cities are populated places (class P), neighborhoods are PPLX features,
+    and every other feature can match an exact location name. A query is resolved
+    hierarchically: country -> city -> neighborhood -> exact location name, where each finer
+    level is restricted to the country and to CITY_RADIUS_KM around the matched city.
+    """
+    name = "gazetteer"
+
+    def __init__(self, gazetteer_file, max_results=5):
+        self.max_results = max_results
+        self.latitudes = array('d')
+        self.longitudes = array('d')
+        self.populations = array('q')
+        self.country_codes = []
+        self.country_index = {}
+        self.city_index = {}
+        self.neighborhood_index = {}
+        self.place_index = {}
+        with open(gazetteer_file, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip() or line.startswith("#"):
+                    continue
+                self._add_place(line.rstrip("\n").split("\t"))
+
+    def _add_place(self, columns):
+        name, ascii_name, alternate_names = columns[1], columns[2], columns[3]
+        feature_class, feature_code, country_code = columns[6], columns[7], columns[8]
+        population = columns[14] if len(columns) > 14 and columns[14] else "0"
+        place_id = len(self.latitudes)
+        self.latitudes.append(float(columns[4]))
+        self.longitudes.append(float(columns[5]))
+        self.populations.append(int(population))
+        self.country_codes.append(country_code)
+
+        if feature_code in COUNTRY_FEATURE_CODES:
+            index = self.country_index
+        elif feature_code in NEIGHBORHOOD_FEATURE_CODES:
+            index = self.neighborhood_index
+        elif feature_class == "P":
+            index = self.city_index
+        else:
+            index = self.place_index
+        names = {name, ascii_name} | set(
+            alternate_name for alternate_name in alternate_names.split(",") if alternate_name)
+        for place_name in names:
+            normalized_name = _normalize_name(place_name)
+            if normalized_name:
+                index.setdefault(normalized_name, []).append(place_id)
+
+    def _lookup(self, index, name, country_code=None, near=None):
+        candidates = index.get(_normalize_name(name), [])
+        if country_code is not None:
+            candidates = [place_id for place_id in candidates if self.country_codes[place_id] == country_code]
+        if near is not None:
+            candidates = [place_id for place_id in candidates if _approximate_distance_km(
+                self.latitudes[place_id], self.longitudes[place_id], *near) <= CITY_RADIUS_KM]
+        # most populous places first
+        return sorted(candidates, key=lambda place_id: (-self.populations[place_id], place_id))
+
+    def geocode(self, query_params):
+        country, city = query_params.get("country", ""), query_params.get("city", "")
+        neighborhood, location_name = query_params.get("street", ""), query_params.get("name", "")
+
+        country_code, near = None, None
+        matches, confidence = [], 0
+        if country:
+            countries = self._lookup(self.country_index, country)
+            if countries:
+                country_code = self.country_codes[countries[0]]
+                matches, confidence = countries[:1], 0.25
+        if city:
+            cities = self._lookup(self.city_index, city, country_code)
+            if cities:
+                near = (self.latitudes[cities[0]], self.longitudes[cities[0]])
+                matches, confidence = cities, 0.5
+        if neighborhood:
+            neighborhoods = self._lookup(self.neighborhood_index, neighborhood, country_code, near)
+            if neighborhoods:
+                matches, confidence = neighborhoods, 0.75
+        if location_name:
+            places = self._lookup(self.place_index, location_name, country_code, near) or \
+                self._lookup(self.neighborhood_index, location_name, country_code, near) or \
+                self._lookup(self.city_index, location_name, country_code, near)
+            if places:
+                matches, confidence = places, 1
+        matches = matches[:self.max_results]
+        return [(self.latitudes[place_id], self.longitudes[place_id]) for place_id in matches], [confidence] * len(matches)
+
+    def geocode_many(self, queries):
+        return [self.geocode(query_params) for query_params in queries]
+
+
+GEOCODER_BACKENDS = {backend.name: backend for backend in (GeoapifyBackend, GazetteerBackend)}
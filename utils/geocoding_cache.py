@@ -0,0 +1,139 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+# query params that do not change the geocoding result
+IGNORED_QUERY_PARAMS = {"apiKey", "format"}
+
+
+def normalize_query_params(query_params):
+    # casefold and collapse whitespace so trivially different spellings share an entry
+    normalized = {}
+    for key, value in query_params.items():
+        if key in IGNORED_QUERY_PARAMS or not value:
+            continue
+        value = " ".join(str(value).split()).casefold()
+        if value:
+            normalized[key] = value
+    return normalized
+
+
+def get_query_params(location_data):
+    return {
+        "name": location_data.get("exact_location_name", ""),
+        "street": location_data.get("neighborhood", ""),
+        "city": location_data.get("city", ""),
+        "country": location_data.get("country", ""),
+    }
+
+
+def get_cache_key(query_params):
+    normalized = normalize_query_params(query_params)
+    return hashlib.sha1(json.dumps(normalized, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class GeocodingCache:
+    """
+    Persistent cache of geocoding API results keyed by the normalized query params.
+
+    The cache is shared by every agent and granularity, so a revealed location tuple is only
+    sent to the geocoding API once. It is bounded to max_entries with LRU eviction, entries
+    older than ttl seconds (if set) are treated as misses, and hits/misses are counted.
+    The cache can be shared by threads.
+    """
+
+    def __init__(self, cache_file=None, max_entries=100000, ttl=None):
+        self.cache_file = cache_file
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        self.lock = threading.RLock()
+        if cache_file and os.path.exists(cache_file):
+            with open(cache_file, "r") as f:
+                for key, entry in json.load(f).items():
+                    self.entries[key] = entry
+            self._evict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries and not self._expired(self.entries[key])
+
+    def _expired(self, entry):
+        return self.ttl is not None and time.time() - entry["timestamp"] > self.ttl
+
+    def _evict(self):
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.dirty = True
+
+    def get(self, key):
+        with self.lock:
+            return self._get(key)
+
+    def _get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and self._expired(entry):
+            del self.entries[key]
+            self.dirty = True
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry["points"], entry["confidences"]
+
+    def put(self, key, points, confidences, timestamp=None):
+        with self.lock:
+            self.entries[key] = {"points": [list(point) for point in points], "confidences": list(confidences),
+                                 "timestamp": time.time() if timestamp is None else timestamp}
+            self.entries.move_to_end(key)
+            self.dirty = True
+            self._evict()
+
+    def warm_from_results(self, results_dir="api_distance_responses"):
+        # seed the cache with the API results already saved for every agent
+        if not os.path.isdir(results_dir):
+            return
+        for filename in sorted(os.listdir(results_dir)):
+            if not filename.endswith(".jsonl"):
+                continue
+            timestamp = os.path.getmtime(os.path.join(results_dir, filename))
+            with open(os.path.join(results_dir, filename), "r") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    revealed = record.get("revealed", {})
+                    if all(value == "" for value in revealed.values()):
+                        continue
+                    key = get_cache_key(get_query_params(revealed))
+                    if key not in self.entries:
+                        self.put(key, record.get("points", []),
+                                 record.get("confidences", []), timestamp)
+
+    def save(self):
+        with self.lock:
+            if not self.cache_file or not self.dirty:
+                return
+            directory = os.path.dirname(self.cache_file)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            tmp_file = f"{self.cache_file}.tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_file, self.cache_file)
+            self.dirty = False
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses,
+                "hit_rate": 0 if total == 0 else self.hits / total}
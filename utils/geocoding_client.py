@@ -0,0 +1,171 @@
+import os
+import time
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from utils import profiling
+
+GEOAPIFY_BASE_URL = "https://api.geoapify.com/v1/geocode/search"
+# the free Geoapify plan allows 5 requests per second
+GEOAPIFY_REQUESTS_PER_SECOND = 5
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: allows `rate` acquisitions per second with bursts of up to `capacity`.
+    A rate of None disables the limit.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1, rate or 1)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate is None:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens +
+                                  (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def parse_geocoding_response(data):
+    points = []
+    confidences = []
+    if 'results' in data:
+        for result in data['results']:
+            lat = result.get('lat')
+            lon = result.get('lon')
+            confidence = result.get('rank', {}).get('confidence')
+
+            if lat is not None and lon is not None and confidence is not None:
+                points.append((lat, lon))
+                confidences.append(confidence)
+    return points, confidences
+
+
+class GeocodingClient:
+    """
+    Geocoding API client with a pooled session, a token-bucket rate limit, retries with
+    exponential backoff for 429/5xx responses and a configurable number of requests in flight.
+
+    A request that fails (any other error status, or retries exhausted) resolves to None
+    instead of raising, so one bad query does not abort a batch. Results of geocode_many are
+    returned in the same order as the queries, failed ones as no results.
+
+    Concurrent batches (e.g. of several agents) share one pool of max_workers threads, so no
+    more requests are in flight than the session has pooled connections.
+    """
+
+    def __init__(self, api_key=None, base_url=GEOAPIFY_BASE_URL, max_workers=8,
+                 requests_per_second=GEOAPIFY_REQUESTS_PER_SECOND, max_retries=5,
+                 backoff_factor=0.5, timeout=10):
+        self.api_key = api_key if api_key is not None else os.getenv("GEOAPIFY_API_KEY")
+        self.base_url = base_url
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.rate_limiter = TokenBucket(requests_per_second)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.num_requests = 0
+        self.lock = threading.Lock()
+        # created on the first concurrent batch
+        self.executor = None
+
+    def search(self, query_params):
+        """
+        Returns:
+            The JSON response of the API, or None if the request failed.
+        """
+        params = {k: v for k, v in query_params.items() if v}
+        params.update({"format": "json", "apiKey": self.api_key})
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            with self.lock:
+                self.num_requests += 1
+            profiling.count("geocoding_api_requests")
+            try:
+                response = self.session.get(
+                    self.base_url, params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt < self.max_retries:
+                    time.sleep(self.backoff_factor * 2 ** attempt)
+                    continue
+                break
+            if response.status_code in RETRY_STATUS_CODES and attempt < self.max_retries:
+                retry_after = response.headers.get("Retry-After")
+                if retry_after is not None and retry_after.isdigit():
+                    time.sleep(int(retry_after))
+                else:
+                    time.sleep(self.backoff_factor * 2 ** attempt)
+                continue
+            if response.ok:
+                try:
+                    return response.json()
+                except ValueError:
+                    pass
+            break
+        profiling.count("geocoding_api_failures")
+        return None
+
+    def geocode(self, query_params):
+        # (points, confidences), or None if the request failed
+        data = self.search(query_params)
+        return None if data is None else parse_geocoding_response(data)
+
+    def iter_geocode(self, queries):
+        """
+        Resolves queries concurrently, yielding the results as they complete.
+
+        Yields:
+            Lists of (query index, result) pairs, a result being (points, confidences) or None
+            if the request failed. Identical queries are only sent once and are yielded together.
+        """
+        query_indices = {}
+        for idx, query_params in enumerate(queries):
+            query_indices.setdefault(tuple(sorted(query_params.items())), []).append(idx)
+        if self.max_workers <= 1 or len(query_indices) <= 1:
+            for indices in query_indices.values():
+                result = self.geocode(queries[indices[0]])
+                yield [(idx, result) for idx in indices]
+            return
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        futures = {self.executor.submit(self.geocode, queries[indices[0]]): indices for indices in query_indices.values()}
+        try:
+            for future in as_completed(futures):
+                result = future.result()
+                yield [(idx, result) for idx in futures[future]]
+        finally:
+            # requests not sent yet are dropped if the caller stops early
+            for future in futures:
+                future.cancel()
+
+    def geocode_many(self, queries):
+        results = [None] * len(queries)
+        for resolved in self.iter_geocode(queries):
+            for idx, result in resolved:
+                results[idx] = ([], []) if result is None else result
+        return results
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+        self.session.close()
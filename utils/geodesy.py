@@ -0,0 +1,69 @@
+import numpy as np
+
+# Earth's radius in kilometers (mean radius = 6,371 km)
+EARTH_RADIUS_KM = 6371.0
+# distances (km) at which the geocoding guesses are counted
+DISTANCE_THRESHOLDS = [0.1, 1, 25, 200, 750, 2500]
+
+
+def weighted_centroids(latitudes, longitudes, weights, offsets):
+    """
+    Calculates the weighted centroids of many sets of points on a sphere at once.
+
+    The point sets are ragged: set i holds the points offsets[i]:offsets[i + 1] of the flat
+    latitude, longitude and weight arrays. As in weighted_centroid, a set whose weights are all
+    0 is weighted uniformly.
+
+    Args:
+        latitudes: flat array of latitudes in degrees.
+        longitudes: flat array of longitudes in degrees.
+        weights: flat array of weights.
+        offsets: array of num_sets + 1 offsets into the flat arrays (every set must be non-empty).
+
+    Returns:
+        Two arrays (latitudes, longitudes) of the centroids in degrees.
+    """
+    latitudes = np.radians(np.asarray(latitudes, dtype=np.float64))
+    longitudes = np.radians(np.asarray(longitudes, dtype=np.float64))
+    weights = np.asarray(weights, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    set_ids = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    num_sets = len(offsets) - 1
+
+    # set all weights of a set to 1 if all are 0
+    total_weights = np.bincount(set_ids, weights=weights, minlength=num_sets)
+    zero_weight_sets = total_weights == 0
+    weights = np.where(zero_weight_sets[set_ids], 1.0, weights)
+    total_weights = np.bincount(set_ids, weights=weights, minlength=num_sets)
+
+    cos_latitudes = np.cos(latitudes)
+    x = np.bincount(set_ids, weights=weights * cos_latitudes * np.cos(longitudes), minlength=num_sets) / total_weights
+    y = np.bincount(set_ids, weights=weights * cos_latitudes * np.sin(longitudes), minlength=num_sets) / total_weights
+    z = np.bincount(set_ids, weights=weights * np.sin(latitudes), minlength=num_sets) / total_weights
+
+    centroid_longitudes = np.arctan2(y, x)
+    centroid_latitudes = np.arctan2(z, np.hypot(x, y))
+    return np.degrees(centroid_latitudes), np.degrees(centroid_longitudes)
+
+
+def haversine_distances(latitudes1, longitudes1, latitudes2, longitudes2):
+    # element-wise great-circle distances in kilometers between points given in degrees
+    latitudes1, longitudes1, latitudes2, longitudes2 = (np.radians(np.asarray(values, dtype=np.float64))
+                                                        for values in (latitudes1, longitudes1, latitudes2, longitudes2))
+    a = np.sin((latitudes2 - latitudes1) / 2) ** 2 + np.cos(latitudes1) * \
+        np.cos(latitudes2) * np.sin((longitudes2 - longitudes1) / 2) ** 2
+    return EARTH_RADIUS_KM * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def count_within_thresholds(distances, thresholds):
+    """
+    Counts the distances that are <= each threshold with one sort and one searchsorted.
+
+    Returns:
+        A dict mapping each threshold to its count, plus "all" for the number of distances.
+    """
+    sorted_distances = np.sort(np.asarray(distances, dtype=np.float64))
+    counts = np.searchsorted(sorted_distances, np.asarray(thresholds, dtype=np.float64), side="right")
+    distance_thresholds = {threshold: int(count) for threshold, count in zip(thresholds, counts)}
+    distance_thresholds["all"] = len(sorted_distances)
+    return distance_thresholds
@@ -0,0 +1,141 @@
+import os
+import json
+from array import array
+from utils import profiling
+
+GRANULARITIES = ["country", "city", "neighborhood",
+                 "exact_location_name", "exact_gps_coordinates"]
+GRANULARITY_BITS = {granularity: 1 << idx for idx,
+                    granularity in enumerate(GRANULARITIES)}
+# one record per turn with the bitmask of the granularities it reveals
+TURNS_FILE = "ground_truth_turns.jsonl"
+
+
+def read_results_turn_masks(f):
+    """
+    Reads a per-image results file written by generate_ground_truths.py, either one record per
+    turn with its ground truth mask or (older files) one record per turn and granularity.
+
+    Returns:
+        A dict mapping each (1-based) turn number to its ground truth mask.
+    """
+    masks = {}
+    num_lines = 0
+    for num_lines, line in enumerate(f, 1):
+        line = json.loads(line)
+        if "ground_truth_mask" in line:
+            masks[line["dialogue_turn_no"]] = line["ground_truth_mask"]
+            continue
+        masks.setdefault(line["dialogue_turn_no"], 0)
+        if line["ground_truth"]:
+            masks[line["dialogue_turn_no"]] |= GRANULARITY_BITS[line["granularity"].replace(" ", "_")]
+    profiling.count_file_read(f, num_lines)
+    return masks
+
+
+class GroundTruthStore:
+    """
+    In-memory ground truths for every (image, turn) of the test set.
+
+    Each turn is stored as a bitmask of the granularities at which it reveals new location
+    information (bit i is set for GRANULARITIES[i]). Turns are packed per image into one array,
+    image i owning turn_masks[turn_offsets[i]:turn_offsets[i + 1]].
+
+    The store is loaded from the per-turn masks in ground_truth_dir (TURNS_FILE), falling back
+    to its per-granularity files and then to the per-image files in results_dir. All are
+    written by generate_ground_truths.py and hold the same labels.
+    """
+
+    def __init__(self, ground_truth_dir="moderation_decisions_ground_truth", results_dir="gptgeochat/human/ground_truth_results"):
+        self.ground_truth_dir = ground_truth_dir
+        self.results_dir = results_dir
+        if os.path.exists(os.path.join(ground_truth_dir, TURNS_FILE)):
+            image_turn_masks = self._load_turns_file(os.path.join(ground_truth_dir, TURNS_FILE))
+        elif os.path.isdir(ground_truth_dir):
+            image_turn_masks = self._load_granularity_files(ground_truth_dir)
+        else:
+            image_turn_masks = self._load_results_files(results_dir)
+
+        self.image_ids = list(image_turn_masks)
+        self.image_index = {image_id: idx for idx,
+                            image_id in enumerate(self.image_ids)}
+        self.turn_offsets = array('q', [0])
+        self.turn_masks = array('B')
+        for image_id in self.image_ids:
+            masks = image_turn_masks[image_id]
+            self.turn_masks.extend(masks[turn_no]
+                                   for turn_no in range(1, len(masks) + 1))
+            self.turn_offsets.append(len(self.turn_masks))
+
+    @staticmethod
+    def _load_turns_file(turns_file):
+        image_turn_masks = {}
+        with open(turns_file, "r") as f:
+            num_lines = 0
+            for num_lines, line in enumerate(f, 1):
+                line = json.loads(line)
+                image_id, turn_no = line["question_id"].rsplit("_", 1)
+                image_turn_masks.setdefault(image_id, {})[int(turn_no)] = line["ground_truth_mask"]
+            profiling.count_file_read(f, num_lines)
+        return image_turn_masks
+
+    @staticmethod
+    def _load_granularity_files(ground_truth_dir):
+        image_turn_masks = {}
+        for granularity in GRANULARITIES:
+            bit = GRANULARITY_BITS[granularity]
+            with open(f"{ground_truth_dir}/ground_truth_granularity={granularity}.jsonl", "r") as f:
+                num_lines = 0
+                for num_lines, line in enumerate(f, 1):
+                    line = json.loads(line)
+                    image_id, turn_no = line["question_id"].rsplit("_", 1)
+                    masks = image_turn_masks.setdefault(image_id, {})
+                    masks.setdefault(int(turn_no), 0)
+                    if line["ground_truth"].capitalize() == "Yes":
+                        masks[int(turn_no)] |= bit
+                profiling.count_file_read(f, num_lines)
+        return image_turn_masks
+
+    @staticmethod
+    def _load_results_files(results_dir):
+        image_turn_masks = {}
+        for filename in os.listdir(results_dir):
+            if not filename.startswith("ground_truths_"):
+                continue
+            image_id = filename[len("ground_truths_"):-len(".jsonl")]
+            with open(os.path.join(results_dir, filename), "r") as f:
+                image_turn_masks[image_id] = read_results_turn_masks(f)
+        return image_turn_masks
+
+    def __contains__(self, image_id):
+        return image_id in self.image_index
+
+    def get_turn_masks(self, image_id):
+        idx = self.image_index[image_id]
+        return self.turn_masks[self.turn_offsets[idx]:self.turn_offsets[idx + 1]]
+
+    def get_label(self, question_id, granularity):
+        image_id, turn_no = question_id.rsplit("_", 1)
+        idx = self.image_index[image_id]
+        return bool(self.turn_masks[self.turn_offsets[idx] + int(turn_no) - 1] & GRANULARITY_BITS[granularity])
+
+    def get_labels(self, question_ids, granularity):
+        return [self.get_label(question_id, granularity) for question_id in question_ids]
+
+    def get_turn_labels(self, image_id, turn_numbers, granularity):
+        # labels of (1-based) turns of one image, without building question ids
+        offset = self.turn_offsets[self.image_index[image_id]] - 1
+        bit = GRANULARITY_BITS[granularity]
+        return [bool(self.turn_masks[offset + turn_no] & bit) for turn_no in turn_numbers]
+
+
+# stores loaded in this process, keyed by their source directories
+_ground_truth_stores = {}
+
+
+def get_ground_truth_store(ground_truth_dir="moderation_decisions_ground_truth", results_dir="gptgeochat/human/ground_truth_results"):
+    key = (ground_truth_dir, results_dir)
+    if key not in _ground_truth_stores:
+        _ground_truth_stores[key] = GroundTruthStore(
+            ground_truth_dir, results_dir)
+    return _ground_truth_stores[key]
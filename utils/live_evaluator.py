@@ -0,0 +1,188 @@
+import json
+import threading
+from bisect import bisect_left
+from utils.bootstrap_utils import binary_scores
+from utils.decisions import parse_decision
+from utils.ground_truth_store import GRANULARITIES, GRANULARITY_BITS, get_ground_truth_store
+from utils.metric_utils import update_turn_result
+from utils.geodesy import DISTANCE_THRESHOLDS
+
+# geocoding distance is not defined for exact gps coordinates
+GEOCODING_GRANULARITIES = [granularity for granularity in GRANULARITIES if granularity != "exact_gps_coordinates"]
+
+
+def new_state(thresholds=DISTANCE_THRESHOLDS):
+    """
+    Returns the empty state of a LiveEvaluator.
+
+    The state only holds counts (and the open conversations), so it can be saved as JSON and
+    the states of evaluators fed with disjoint streams can be merged with merge_states:
+        confusion: per granularity, the [tn, fp, fn, tp] counts of the decisions.
+        withheld, leaked: per granularity, [count, total] over the closed conversations.
+        distances: per granularity, the number of closed conversations whose geocoding distance
+            falls in each bin of the thresholds (the last bin is beyond the largest threshold).
+    """
+    return {"num_decisions": 0, "num_conversations": 0, "thresholds": list(thresholds),
+            "confusion": {granularity: [0, 0, 0, 0] for granularity in GRANULARITIES},
+            "withheld": {granularity: [0, 0] for granularity in GRANULARITIES},
+            "leaked": {granularity: [0, 0] for granularity in GRANULARITIES},
+            "distances": {granularity: [0] * (len(thresholds) + 1) for granularity in GEOCODING_GRANULARITIES},
+            "open_conversations": {}}
+
+
+def merge_states(state, other_state):
+    # adds the counts of other_state to state (in place); open conversations must be disjoint
+    if state["thresholds"] != other_state["thresholds"]:
+        raise ValueError("Cannot merge states with different distance thresholds")
+    shared_conversations = set(state["open_conversations"]) & set(other_state["open_conversations"])
+    if shared_conversations:
+        raise ValueError(f"Both states have open conversations for images {sorted(shared_conversations)}")
+    state["num_decisions"] += other_state["num_decisions"]
+    state["num_conversations"] += other_state["num_conversations"]
+    for key in ("confusion", "withheld", "leaked", "distances"):
+        for granularity, counts in other_state[key].items():
+            state[key][granularity] = [count + other_count for count, other_count in zip(state[key][granularity], counts)]
+    state["open_conversations"].update(other_state["open_conversations"])
+    return state
+
+
+class LiveEvaluator:
+    """
+    Evaluates a moderation agent online, from its decisions as they are made.
+
+    Decisions are {"question_id", "predicted"} events. Conversations may interleave but the turns
+    of a conversation must arrive in order. Each decision updates the confusion counts of every
+    granularity and the withheld/leaked result of its conversation (with the per-turn logic of
+    get_gpt_result_ground_truth), so the cost per decision does not grow with the stream.
+
+    A conversation closes when its last annotated turn arrives (or on close_conversation, in
+    which case the turns not received are left out of the conversation: they can neither be
+    withheld nor leak, and reveal nothing to the geocoder). Its withheld/leaked results and, if
+    enabled, its geocoding distances are then added to the totals. Geocoding happens outside the
+    lock, so other decisions are not held up by the geocoder.
+    """
+
+    def __init__(self, ground_truth_dir="moderation_decisions_ground_truth", geocoding_distance=False,
+                 ground_truth_location_data_file="ground_truth_location_data.json", thresholds=DISTANCE_THRESHOLDS, state=None,
+                 results_dir="api_distance_responses"):
+        self.ground_truth_store = get_ground_truth_store(ground_truth_dir)
+        self.geocoding_distance = geocoding_distance
+        # geocoding results are memoized per results directory, i.e. per geocoder
+        self.results_dir = results_dir
+        self.ground_truth_location_data = None
+        if geocoding_distance:
+            with open(ground_truth_location_data_file, "r") as f:
+                self.ground_truth_location_data = json.load(f)
+        self.state = state if state is not None else new_state(thresholds)
+        # decisions may come from several threads (e.g. the HTTP server)
+        self.lock = threading.RLock()
+
+    def add_decision(self, question_id, predicted):
+        """
+        Adds one decision.
+
+        Returns:
+            True if the decision closed its conversation.
+        """
+        image_id, turn_no, moderated = parse_decision(question_id, predicted)
+        turn_masks = self.ground_truth_store.get_turn_masks(image_id)
+        if turn_no > len(turn_masks):
+            raise ValueError(f"Image {image_id} only has {len(turn_masks)} annotated turns")
+
+        with self.lock:
+            conversation = self.state["open_conversations"].get(image_id)
+            expected_turn_no = 1 if conversation is None else len(conversation["include_turn"]) + 1
+            if turn_no != expected_turn_no:
+                raise ValueError(f"Expected turn {expected_turn_no} of image {image_id}, got turn {turn_no}")
+            if conversation is None:
+                conversation = {"include_turn": [], "results": {granularity: {} for granularity in GRANULARITIES}}
+                self.state["open_conversations"][image_id] = conversation
+            revealed = turn_masks[turn_no - 1]
+            conversation["include_turn"].append(not moderated)
+            for granularity in GRANULARITIES:
+                granularity_bit = GRANULARITY_BITS[granularity]
+                # outcomes are encoded as 0: TN, 1: FP, 2: FN, 3: TP
+                label = 1 if revealed & granularity_bit else 0
+                self.state["confusion"][granularity][moderated + 2 * label] += 1
+                update_turn_result(conversation["results"][granularity], revealed, not moderated, granularity_bit)
+            self.state["num_decisions"] += 1
+            if turn_no < len(turn_masks):
+                return False
+            conversation = self._pop_conversation(image_id)
+        self._add_distances(image_id, conversation)
+        return True
+
+    def add_event(self, event):
+        return self.add_decision(event["question_id"], event["predicted"])
+
+    def close_conversation(self, image_id):
+        with self.lock:
+            conversation = self._pop_conversation(image_id)
+        self._add_distances(image_id, conversation)
+
+    def _pop_conversation(self, image_id):
+        # removes an open conversation and adds its withheld/leaked results; the lock must be held
+        conversation = self.state["open_conversations"].pop(image_id)
+        for granularity, results in conversation["results"].items():
+            for key in ("withheld", "leaked"):
+                if key in results:
+                    self.state[key][granularity][0] += int(results[key])
+                    self.state[key][granularity][1] += 1
+        self.state["num_conversations"] += 1
+        return conversation
+
+    def _add_distances(self, image_id, conversation):
+        # geocodes a closed conversation without the lock, then adds its distances
+        if not self.geocoding_distance:
+            return
+        from utils.geocoding_utils import get_conversation_distance
+        distances = [(granularity, get_conversation_distance(image_id, conversation["include_turn"], granularity,
+                                                             self.ground_truth_location_data[image_id], self.results_dir))
+                     for granularity in GEOCODING_GRANULARITIES]
+        with self.lock:
+            for granularity, distance in distances:
+                if distance is not None:
+                    self.state["distances"][granularity][bisect_left(self.state["thresholds"], distance)] += 1
+
+    def save_geocoding_cache(self):
+        # saves the geocoding queries resolved so far (nothing if none is new)
+        if not self.geocoding_distance:
+            return
+        from utils.geocoding_utils import get_geocoding_cache
+        get_geocoding_cache().save()
+
+    def merge(self, state):
+        with self.lock:
+            merge_states(self.state, state)
+
+    def get_state(self):
+        with self.lock:
+            return json.loads(json.dumps(self.state))
+
+    def get_metrics(self):
+        """
+        Returns:
+            The current metrics of every granularity: recall, precision and F1 of the decisions,
+            withheld and leaked proportions and the percentage of geocoding distances within
+            each threshold (of the closed conversations).
+        """
+        with self.lock:
+            metrics = {"decisions": self.state["num_decisions"], "closed_conversations": self.state["num_conversations"],
+                       "open_conversations": len(self.state["open_conversations"]), "granularities": {}}
+            for granularity in GRANULARITIES:
+                tn, fp, fn, tp = self.state["confusion"][granularity]
+                recall, precision, f1 = binary_scores(tp, fp, fn)
+                withheld, withheld_total = self.state["withheld"][granularity]
+                leaked, leaked_total = self.state["leaked"][granularity]
+                granularity_metrics = {"recall": float(recall), "precision": float(precision), "f1": float(f1),
+                                       "tp": tp, "fp": fp, "fn": fn, "tn": tn,
+                                       "withheld_proportion": 0 if withheld_total == 0 else withheld / withheld_total,
+                                       "leaked_proportion": 0 if leaked_total == 0 else leaked / leaked_total}
+                if self.geocoding_distance and granularity in self.state["distances"]:
+                    bins = self.state["distances"][granularity]
+                    total = sum(bins)
+                    granularity_metrics["distances"] = {f"within {threshold} km": 0 if total == 0 else sum(bins[:idx + 1]) / total
+                                                        for idx, threshold in enumerate(self.state["thresholds"])}
+                    granularity_metrics["distances"]["all"] = total
+                metrics["granularities"][granularity] = granularity_metrics
+            return metrics
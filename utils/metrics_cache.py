@@ -0,0 +1,91 @@
+import os
+import json
+import pickle
+import hashlib
+
+# bump when a change to the metric code invalidates previously cached results
+METRICS_CACHE_VERSION = 1
+
+_file_hashes = {}
+
+
+def hash_file(file_path):
+    # content hash of a file, memoized on its path, size and mtime
+    if not os.path.exists(file_path):
+        return None
+    stat = os.stat(file_path)
+    memo_key = (file_path, stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _file_hashes:
+        with open(file_path, "rb") as f:
+            _file_hashes[memo_key] = hashlib.sha256(f.read()).hexdigest()
+    return _file_hashes[memo_key]
+
+
+def get_ground_truth_version(ground_truth_dir="moderation_decisions_ground_truth"):
+    if not os.path.isdir(ground_truth_dir):
+        return None
+    return {filename: hash_file(os.path.join(ground_truth_dir, filename))
+            for filename in sorted(os.listdir(ground_truth_dir)) if filename.endswith(".jsonl")}
+
+
+def get_api_results_file(task):
+    # saved geocoding results of a geocoding task's agent
+    return f"{task.kwargs.get('results_dir', 'api_distance_responses')}/api_distance_results_{task.model}.jsonl"
+
+
+def get_task_inputs(task, ground_truth_version):
+    """
+    Everything the result of a task depends on: its answers file, the ground truths and the
+    experiment parameters (plus the saved API results and location data for geocoding).
+    """
+    inputs = {"version": METRICS_CACHE_VERSION, "experiment": task.experiment, "granularity": task.granularity,
+              "answers": hash_file(task.filename), "ground_truth": ground_truth_version,
+              "params": {key: value for key, value in task.kwargs.items() if key != "recompute"}}
+    if task.experiment == "geocoding_distance":
+        inputs.update({
+            "model": task.model,
+            "api_results": hash_file(get_api_results_file(task)),
+            "location_data": hash_file("ground_truth_location_data.json"),
+            "annotations": hash_file("gptgeochat/human/ground_truth_results/manifest.json"),
+        })
+    return inputs
+
+
+def get_task_key(task, ground_truth_version):
+    return hashlib.sha256(json.dumps(get_task_inputs(task, ground_truth_version), sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class MetricsCache:
+    """
+    Persistent cache of experiment results keyed by the hash of the task inputs.
+    """
+
+    def __init__(self, cache_file=".metrics_cache/metrics_cache.pkl"):
+        self.cache_file = cache_file
+        self.entries = {}
+        self.dirty = False
+        if os.path.exists(cache_file):
+            with open(cache_file, "rb") as f:
+                self.entries = pickle.load(f)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, result):
+        self.entries[key] = result
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        directory = os.path.dirname(self.cache_file)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        tmp_file = f"{self.cache_file}.tmp"
+        with open(tmp_file, "wb") as f:
+            pickle.dump(self.entries, f)
+        os.replace(tmp_file, self.cache_file)
+        self.dirty = False
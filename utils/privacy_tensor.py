@@ -0,0 +1,163 @@
+import numpy as np
+from utils.decisions import load_decisions
+from utils.ground_truth_store import GRANULARITIES, get_ground_truth_store
+
+
+def get_max_turns(num_turns):
+    return int(num_turns.max()) if len(num_turns) else 0
+
+
+def build_ground_truth_tensor(ground_truth_store, start=0, end=None, max_turns=None):
+    """
+    Unpacks the ground truth bitmasks of the images start:end (every image by default) into an
+    images x turns x granularities boolean tensor.
+
+    Conversations shorter than max_turns (the longest one by default) are padded with turns
+    that reveal nothing.
+
+    Returns:
+        The tensor and the number of turns of each image.
+    """
+    turn_offsets = np.frombuffer(ground_truth_store.turn_offsets, dtype=np.int64)
+    if max_turns is None:
+        max_turns = get_max_turns(np.diff(turn_offsets))
+    end = len(turn_offsets) - 1 if end is None else min(end, len(turn_offsets) - 1)
+    turn_offsets = turn_offsets[start:end + 1]
+    turn_masks = np.frombuffer(ground_truth_store.turn_masks, dtype=np.uint8)[turn_offsets[0]:turn_offsets[-1]]
+    num_turns = np.diff(turn_offsets)
+    # position of each turn in its conversation
+    image_rows = np.repeat(np.arange(len(num_turns)), num_turns)
+    turn_positions = np.arange(len(turn_masks)) - np.repeat(turn_offsets[:-1] - turn_offsets[0], num_turns)
+    masks = np.zeros((len(num_turns), max_turns), dtype=np.uint8)
+    masks[image_rows, turn_positions] = turn_masks
+    revealed = (masks[:, :, None] >> np.arange(len(GRANULARITIES), dtype=np.uint8)) & 1
+    return revealed.astype(bool), num_turns
+
+
+def index_moderation_decisions(answers_files, ground_truth_store, num_turns):
+    """
+    Matches the decision lines of every agent to the rows of the ground truth store, for
+    build_moderation_tensor.
+
+    Turns are matched to the ground truths by their position in the conversation, as in
+    get_gpt_result_ground_truth.
+
+    Returns:
+        For each agent, the (image rows, positions, included) arrays of its decision lines,
+        sorted by image row, and the agents x images boolean matrix of the images each agent has
+        a conversation for.
+    """
+    max_turns = get_max_turns(num_turns)
+    agent_lines = []
+    present = np.zeros((len(answers_files), len(num_turns)), dtype=bool)
+    for agent_idx, answers_file in enumerate(answers_files):
+        decisions = load_decisions(answers_file)
+        image_rows = np.array([ground_truth_store.image_index[image_id]
+                               for image_id in decisions.image_ids], dtype=np.int64)
+        conversation_offsets = np.frombuffer(decisions.conversation_offsets, dtype=np.int64)
+        conversation_lengths = np.diff(conversation_offsets)
+        line_rows = image_rows[np.frombuffer(decisions.image_indices, dtype=np.uint32)]
+        conversation_rows = line_rows[conversation_offsets[:-1]]
+        if len(np.unique(conversation_rows)) != len(conversation_rows):
+            raise ValueError(f"{answers_file} has more than one conversation for an image")
+        if np.any(conversation_lengths < num_turns[conversation_rows]):
+            raise ValueError(f"{answers_file} has conversations with fewer turns than their ground truths")
+        # decisions past the annotated turns are ignored
+        positions = np.arange(len(decisions)) - np.repeat(conversation_offsets[:-1], conversation_lengths)
+        in_range = np.flatnonzero(positions < max_turns)
+        in_range = in_range[np.argsort(line_rows[in_range], kind="stable")]
+        agent_lines.append((line_rows[in_range], positions[in_range],
+                            np.frombuffer(decisions.moderated, dtype=np.uint8)[in_range] == 0))
+        present[agent_idx, conversation_rows] = True
+    return agent_lines, present
+
+
+def build_moderation_tensor(agent_lines, start, end, max_turns):
+    """
+    Stacks the moderation decisions of every agent on the images start:end into an agents x
+    images x turns boolean tensor of the included (not moderated) turns.
+
+    Args:
+        agent_lines: The per-agent decision lines of index_moderation_decisions.
+    """
+    included = np.zeros((len(agent_lines), end - start, max_turns), dtype=bool)
+    for agent_idx, (line_rows, positions, line_included) in enumerate(agent_lines):
+        first, last = np.searchsorted(line_rows, [start, end])
+        included[agent_idx, line_rows[first:last] - start, positions[first:last]] = line_included[first:last]
+    return included
+
+
+def iter_withheld_leaked_chunks(answers_files, ground_truth_store, chunk_size=8192):
+    """
+    Computes the withheld and leaked outcomes (see get_withheld_leaked) chunk_size images at a
+    time, building the ground truth and moderation tensors of each chunk only, to bound the
+    size of the tensors.
+
+    Returns:
+        An iterator of (start, end, outcomes) tuples, outcomes being the four agents x images x
+        granularities tensors of get_withheld_leaked for the images start:end.
+    """
+    num_turns = np.diff(np.frombuffer(ground_truth_store.turn_offsets, dtype=np.int64))
+    max_turns = get_max_turns(num_turns)
+    agent_lines, present = index_moderation_decisions(answers_files, ground_truth_store, num_turns)
+    for start in range(0, len(num_turns), chunk_size):
+        end = min(start + chunk_size, len(num_turns))
+        revealed, _ = build_ground_truth_tensor(ground_truth_store, start, end, max_turns)
+        included = build_moderation_tensor(agent_lines, start, end, max_turns)
+        yield start, end, get_withheld_leaked(revealed, included, present[:, start:end])
+
+
+def get_withheld_leaked(revealed, included, present):
+    """
+    Computes the withheld and leaked outcomes of every conversation of every agent at every
+    granularity.
+
+    For a conversation and a granularity, a leak is possible if a turn reveals the granularity
+    and happens if such a turn is not moderated. Withholding is possible if a turn reveals a
+    coarser granularity but not this one, and happens if such a turn is moderated.
+
+    Args:
+        revealed: images x turns x granularities ground truth tensor.
+        included: agents x images x turns tensor of the turns that are not moderated.
+        present: agents x images matrix of the images each agent has a conversation for.
+
+    Returns:
+        Four agents x images x granularities boolean tensors: withheld, withholding possible,
+        leaked and leak possible.
+    """
+    # turns that reveal a coarser granularity (but not this one)
+    coarser_revealed = np.zeros_like(revealed)
+    coarser_revealed[:, :, 1:] = np.logical_or.accumulate(revealed[:, :, :-1], axis=2)
+    withhold_candidates = coarser_revealed & ~revealed
+
+    present = present[:, :, None]
+    withheld = present & (~included[:, :, :, None] & withhold_candidates[None]).any(axis=2)
+    withhold_possible = present & withhold_candidates.any(axis=1)[None]
+    leaked = present & (included[:, :, :, None] & revealed[None]).any(axis=2)
+    leak_possible = present & revealed.any(axis=1)[None]
+    return withheld, withhold_possible, leaked, leak_possible
+
+
+def compute_withheld_leaked_all(answers_files, ground_truth_dir="moderation_decisions_ground_truth", chunk_size=8192):
+    """
+    Computes the withheld and leaked proportions of many agents at every granularity.
+
+    Gives the same proportions as compute_withheld_leaked for each file and granularity.
+
+    Returns:
+        A dict mapping each answers file to a dict mapping each granularity to the
+        (withheld_proportion, leaked_proportion) tuple.
+    """
+    ground_truth_store = get_ground_truth_store(ground_truth_dir)
+    counts = np.zeros((4, len(answers_files), len(GRANULARITIES)), dtype=np.int64)
+    for _, _, outcomes in iter_withheld_leaked_chunks(answers_files, ground_truth_store, chunk_size):
+        counts += np.stack([values.sum(axis=1) for values in outcomes])
+    withheld, withheld_totals, leaked, leaked_totals = counts.tolist()
+
+    def proportion(count, total):
+        return 0 if total == 0 else count / total
+
+    return {answers_file: {granularity: (proportion(withheld[agent_idx][granularity_idx], withheld_totals[agent_idx][granularity_idx]),
+                                         proportion(leaked[agent_idx][granularity_idx], leaked_totals[agent_idx][granularity_idx]))
+                           for granularity_idx, granularity in enumerate(GRANULARITIES)}
+            for agent_idx, answers_file in enumerate(answers_files)}
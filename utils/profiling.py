@@ -0,0 +1,176 @@
+import os
+import json
+import time
+import threading
+from contextlib import nullcontext
+
+# profiler of this process, None when profiling is disabled (the default). Every hook below
+# checks it first, so disabled hooks cost a global lookup and can stay on the hot paths.
+_profiler = None
+_null_span = nullcontext()
+
+
+class Profiler:
+    """
+    Records counters and timed spans (wall and thread CPU time) of an evaluation run.
+
+    Spans are kept as Chrome trace "complete" events so the run can be viewed as a timeline in
+    chrome://tracing or Perfetto. Worker processes run their own profiler, whose records are
+    collected with collect() and merged into the profiler of the main process with merge().
+    """
+
+    def __init__(self, origin_ns=None):
+        # timestamps are relative to origin_ns, shared by the worker processes
+        self.origin_ns = time.perf_counter_ns() if origin_ns is None else origin_ns
+        self.main_pid = os.getpid()
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.events = []
+        self.tasks = []
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_event(self, name, start_ns, end_ns, cpu_ns, args=None):
+        event = {"name": name, "ph": "X", "ts": (start_ns - self.origin_ns) / 1000, "dur": (end_ns - start_ns) / 1000,
+                 "pid": os.getpid(), "tid": threading.get_native_id(), "args": dict(args or {}, cpu_ms=cpu_ns / 1e6)}
+        with self.lock:
+            self.events.append(event)
+
+    def add_task(self, task_info):
+        with self.lock:
+            self.tasks.append(task_info)
+
+    def collect(self):
+        # hand over (and clear) the records of this process
+        with self.lock:
+            records = {"counters": self.counters, "events": self.events, "tasks": self.tasks}
+            self.counters, self.events, self.tasks = {}, [], []
+        return records
+
+    def merge(self, records):
+        with self.lock:
+            for name, n in records["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            self.events.extend(records["events"])
+            self.tasks.extend(records["tasks"])
+
+    def get_summary(self):
+        """
+        Returns:
+            A dict with the total wall time, the counters, the wall and CPU time of each span
+            name (summed over its occurrences) and of each task, slowest first.
+        """
+        stages = {}
+        for event in self.events:
+            stage = stages.setdefault(event["name"], {"count": 0, "wall_s": 0.0, "cpu_s": 0.0})
+            stage["count"] += 1
+            stage["wall_s"] += event["dur"] / 1e6
+            stage["cpu_s"] += event["args"]["cpu_ms"] / 1e3
+        return {"wall_s": (time.perf_counter_ns() - self.origin_ns) / 1e9,
+                "counters": dict(sorted(self.counters.items())),
+                "stages": stages,
+                "tasks": sorted(self.tasks, key=lambda task: -task["wall_s"])}
+
+    def get_chrome_trace(self):
+        pids = sorted({event["pid"] for event in self.events} | {self.main_pid})
+        metadata = [{"name": "process_name", "ph": "M", "pid": pid, "tid": 0,
+                     "args": {"name": "main" if pid == self.main_pid else f"worker {pid}"}} for pid in pids]
+        counters = [{"name": "counters", "ph": "C", "ts": (time.perf_counter_ns() - self.origin_ns) / 1000,
+                     "pid": self.main_pid, "tid": 0, "args": self.counters}]
+        return {"traceEvents": metadata + self.events + counters, "displayTimeUnit": "ms"}
+
+    def save(self, profile_dir):
+        if not os.path.exists(profile_dir):
+            os.makedirs(profile_dir)
+        with open(os.path.join(profile_dir, "summary.json"), "w") as f:
+            json.dump(self.get_summary(), f, indent=2)
+        with open(os.path.join(profile_dir, "trace.json"), "w") as f:
+            json.dump(self.get_chrome_trace(), f)
+
+
+class Span:
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start_ns = time.perf_counter_ns()
+        self.start_cpu_ns = time.thread_time_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.add_event(self.name, self.start_ns, time.perf_counter_ns(),
+                                time.thread_time_ns() - self.start_cpu_ns, self.args)
+
+
+class ProfiledAccumulator:
+    """
+    Wraps an Accumulator to time its updates and its result. The accumulators reading one
+    answers file are updated in turn for each conversation, so the time of each one is summed
+    over its updates and recorded as a task when the result is computed.
+    """
+
+    def __init__(self, accumulator, profiler, task_info):
+        self.accumulator = accumulator
+        self.profiler = profiler
+        self.task_info = task_info
+        self.num_updates = 0
+        self.wall_ns = 0
+        self.cpu_ns = 0
+
+    def update(self, image_id, turn_numbers, moderated):
+        start_ns, start_cpu_ns = time.perf_counter_ns(), time.thread_time_ns()
+        self.accumulator.update(image_id, turn_numbers, moderated)
+        self.wall_ns += time.perf_counter_ns() - start_ns
+        self.cpu_ns += time.thread_time_ns() - start_cpu_ns
+        self.num_updates += 1
+
+    def result(self):
+        with Span(self.profiler, f"{self.task_info['experiment']}.result", self.task_info) as span:
+            result = self.accumulator.result()
+        end_ns, end_cpu_ns = time.perf_counter_ns(), time.thread_time_ns()
+        self.profiler.add_task(dict(self.task_info, updates=self.num_updates,
+                                    update_wall_s=self.wall_ns / 1e9, update_cpu_s=self.cpu_ns / 1e9,
+                                    wall_s=(self.wall_ns + end_ns - span.start_ns) / 1e9,
+                                    cpu_s=(self.cpu_ns + end_cpu_ns - span.start_cpu_ns) / 1e9))
+        return result
+
+
+def enable_profiling(origin_ns=None):
+    # start a new profiler for this process
+    global _profiler
+    _profiler = Profiler(origin_ns)
+    return _profiler
+
+
+def get_profiler():
+    return _profiler
+
+
+def count(name, n=1):
+    if _profiler is not None:
+        _profiler.count(name, n)
+
+
+def count_file_read(f, num_lines=None):
+    # an opened file that is read in full, and the number of JSON lines parsed from it
+    if _profiler is not None:
+        _profiler.count("files_opened")
+        _profiler.count("bytes_read", os.fstat(f.fileno()).st_size)
+        if num_lines is not None:
+            _profiler.count("json_lines_parsed", num_lines)
+
+
+def span(name, **args):
+    if _profiler is None:
+        return _null_span
+    return Span(_profiler, name, args)
+
+
+def profile_accumulator(accumulator, **task_info):
+    if _profiler is None:
+        return accumulator
+    return ProfiledAccumulator(accumulator, _profiler, task_info)
@@ -0,0 +1,206 @@
+import json
+import numpy as np
+from utils import profiling
+from utils.bootstrap_utils import binary_scores
+from utils.conversation_memo import get_conversation_memo
+from utils.ground_truth_store import GRANULARITIES, GRANULARITY_BITS, get_ground_truth_store
+from utils.geocoding_utils import DISTANCE_THRESHOLDS, get_gpt_location_data, iter_geocoding_api_coordinate_guesses, locate_guesses, get_geocoding_cache
+
+# geocoding distance is not defined for exact gps coordinates
+GEOCODING_GRANULARITIES = [granularity for granularity in GRANULARITIES if granularity != "exact_gps_coordinates"]
+# masks are int64 bitmasks over the turns of a conversation
+MAX_TURNS = 62
+
+if hasattr(np, "bitwise_count"):
+    def popcount(values):
+        return np.bitwise_count(values)
+else:
+    _BYTE_POPCOUNTS = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.uint8)
+
+    def popcount(values):
+        values = np.ascontiguousarray(values, dtype=np.int64)
+        return _BYTE_POPCOUNTS[values.view(np.uint8)].reshape(values.shape + (8,)).sum(axis=-1)
+
+
+def build_image_bitmasks(ground_truth_store, granularity):
+    """
+    Packs the ground truths of one granularity into one bitmask per image (bit t for turn t + 1).
+
+    Returns:
+        Three int64 arrays: the turns of each image, the turns that reveal the granularity and
+        the turns that reveal a coarser granularity but not this one (withhold candidates).
+    """
+    turn_offsets = np.frombuffer(ground_truth_store.turn_offsets, dtype=np.int64)
+    turn_masks = np.frombuffer(ground_truth_store.turn_masks, dtype=np.uint8).astype(np.int64)
+    num_turns = np.diff(turn_offsets)
+    image_rows = np.repeat(np.arange(len(num_turns)), num_turns)
+    turn_bits = np.left_shift(1, np.arange(len(turn_masks)) - np.repeat(turn_offsets[:-1], num_turns))
+    bit = GRANULARITY_BITS[granularity]
+    revealed = (turn_masks & bit) != 0
+    withhold_candidates = ((turn_masks & (bit - 1)) != 0) & ~revealed
+
+    def pack(turns):
+        bitmasks = np.zeros(len(num_turns), dtype=np.int64)
+        np.bitwise_or.at(bitmasks, image_rows, np.where(turns, turn_bits, 0))
+        return bitmasks
+
+    return np.left_shift(1, num_turns) - 1, pack(revealed), pack(withhold_candidates)
+
+
+def summarize(values, percentiles):
+    # distribution of a metric over the samples
+    values = np.asarray(values, dtype=np.float64)
+    return {"mean": float(np.mean(values)), "std": float(np.std(values)),
+            "percentiles": {percentile: float(value) for percentile, value in zip(percentiles, np.percentile(values, percentiles))}}
+
+
+class RandomBaselineSimulator:
+    """
+    Monte Carlo evaluation of the random baseline, which moderates each turn with probability 1/2.
+
+    Each sample draws one random moderation mask per image (an int64 bitmask of the included
+    turns) for all images at once; the confusion counts and withheld/leaked outcomes of every
+    sample then follow from a few bitwise operations against the packed ground truths.
+
+    The revealed location data, and so the geocoding distance, of a conversation only depends
+    on its image and mask, not on the granularity. Distances are looked up in the conversation
+    memo, shared with the agents evaluated in the same run, and the pairs not seen yet are
+    geocoded in one batch per chunk of samples. Images have few turns, so the number of
+    distinct masks (and geocoding queries) stays small however many samples are drawn.
+    """
+
+    def __init__(self, ground_truth_dir="moderation_decisions_ground_truth", geocoding_distance=False,
+                 ground_truth_location_data_file="ground_truth_location_data.json", image_ids=None, results_dir="api_distance_responses"):
+        ground_truth_store = get_ground_truth_store(ground_truth_dir)
+        rows = np.arange(len(ground_truth_store.image_ids)) if image_ids is None else \
+            np.array([ground_truth_store.image_index[image_id] for image_id in image_ids], dtype=np.int64)
+        self.image_ids = [ground_truth_store.image_ids[row] for row in rows]
+        self.bitmasks = {}
+        for granularity in GRANULARITIES:
+            self.bitmasks[granularity] = tuple(bitmasks[rows] for bitmasks in build_image_bitmasks(ground_truth_store, granularity))
+        self.full_masks = self.bitmasks[GRANULARITIES[0]][0]
+        self.num_turns = popcount(self.full_masks).astype(np.int64)
+        if len(self.num_turns) and self.num_turns.max() > MAX_TURNS:
+            raise ValueError(f"Conversations with more than {MAX_TURNS} turns are not supported")
+
+        self.geocoding_distance = geocoding_distance
+        self.ground_truth_location_data = None
+        self.located_rows = np.zeros(0, dtype=np.int64)
+        if geocoding_distance:
+            with open(ground_truth_location_data_file, "r") as f:
+                full_ground_truth_location_data = json.load(f)
+                profiling.count_file_read(f)
+            self.ground_truth_location_data = [full_ground_truth_location_data[image_id] for image_id in self.image_ids]
+            # images without ground truth coordinates are left out of the distances
+            self.located_rows = np.array([row for row, location_data in enumerate(self.ground_truth_location_data)
+                                          if location_data["latitude"] != "" and location_data["longitude"] != ""], dtype=np.int64)
+        # distances are memoized in the conversation memo, per geocoder results directory
+        self.results_dir = results_dir
+
+    def draw_masks(self, rng, num_samples):
+        # uniform bitmasks over each image's turns, i.e. every turn included with probability 1/2
+        return rng.integers(0, np.left_shift(1, self.num_turns), size=(num_samples, len(self.num_turns)), dtype=np.int64)
+
+    def get_distances(self, include_masks):
+        """
+        Geocoding distances of the located images for a samples x images matrix of include masks.
+
+        Returns:
+            A samples x located images matrix of distances (999999999 when nothing revealed
+            could be geocoded, or its geocoding request failed; failures are not memoized).
+        """
+        rows = np.broadcast_to(self.located_rows, (len(include_masks), len(self.located_rows)))
+        pairs, inverse = np.unique(np.stack([rows.ravel(), include_masks[:, self.located_rows].ravel()], axis=1),
+                                   axis=0, return_inverse=True)
+        memo = get_conversation_memo()
+        unique_distances = np.empty(len(pairs), dtype=np.float64)
+        missing = []
+        for pair_idx, (row, mask) in enumerate(pairs.tolist()):
+            conversation_key = (self.image_ids[row], int(self.num_turns[row]), mask)
+            geocoding_result = memo.get("distances", (self.results_dir, conversation_key))
+            if geocoding_result is None:
+                missing.append((pair_idx, row, conversation_key))
+            else:
+                unique_distances[pair_idx] = geocoding_result["distance"]
+
+        if missing:
+            # the revealed location data does not depend on the granularity
+            revealed_location_datas = [memo.get_or_compute("revealed", conversation_key, lambda: get_gpt_location_data(
+                conversation_key[0], [bool(conversation_key[2] >> turn_idx & 1) for turn_idx in range(conversation_key[1])], None))
+                for _, _, conversation_key in missing]
+            try:
+                for resolved in iter_geocoding_api_coordinate_guesses(revealed_location_datas):
+                    centroids = locate_guesses([([], []) if guess is None else guess for _, guess in resolved],
+                                               [self.ground_truth_location_data[missing[idx][1]] for idx, _ in resolved])
+                    for resolved_idx, (idx, guess) in enumerate(resolved):
+                        pair_idx, _, conversation_key = missing[idx]
+                        if guess is None:
+                            # failed requests count as unresolved in this call only, so later samples retry them
+                            unique_distances[pair_idx] = 999999999
+                            continue
+                        if resolved_idx in centroids:
+                            centroid, distance = centroids[resolved_idx]
+                            geocoding_result = {"points": guess[0], "confidences": guess[1], "centroid": centroid, "distance": distance}
+                        else:
+                            geocoding_result = {"distance": 999999999}
+                        memo.put("distances", (self.results_dir, conversation_key), geocoding_result)
+                        unique_distances[pair_idx] = geocoding_result["distance"]
+            finally:
+                get_geocoding_cache().save()
+        return unique_distances[inverse.ravel()].reshape(rows.shape)
+
+    def simulate(self, num_samples=1000, seed=None, percentiles=(2.5, 50, 97.5), thresholds=DISTANCE_THRESHOLDS, chunk_size=256):
+        """
+        Evaluates num_samples random baselines.
+
+        The same masks are scored at every granularity, so differences between granularities
+        come from the ground truths only.
+
+        Args:
+            num_samples: number of random baselines.
+            seed: seed for the NumPy random generator.
+            percentiles: percentiles reported for each metric.
+            thresholds: distances (km) at which the geocoding guesses are counted.
+            chunk_size: number of samples evaluated at once.
+
+        Returns:
+            A dict mapping each granularity to the distribution (mean, std and percentiles) of
+            the recall, precision, F1, withheld and leaked proportions and, if enabled, the
+            proportion of geocoding distances within each threshold.
+        """
+        rng = np.random.default_rng(seed)
+        counts = {granularity: {key: [] for key in ("tp", "fp", "fn", "withheld", "leaked")} for granularity in GRANULARITIES}
+        within = []
+        for start in range(0, num_samples, chunk_size):
+            with profiling.span("random_baseline.chunk", samples=min(chunk_size, num_samples - start)):
+                include_masks = self.draw_masks(rng, min(chunk_size, num_samples - start))
+                moderated_masks = self.full_masks ^ include_masks
+                for granularity in GRANULARITIES:
+                    _, revealed, withhold_candidates = self.bitmasks[granularity]
+                    granularity_counts = counts[granularity]
+                    granularity_counts["tp"].append(popcount(moderated_masks & revealed).sum(axis=1))
+                    granularity_counts["fp"].append(popcount(moderated_masks & ~revealed).sum(axis=1))
+                    granularity_counts["fn"].append(popcount(include_masks & revealed).sum(axis=1))
+                    # only images where withholding (leaking) is possible count, as in get_gpt_result_ground_truth
+                    granularity_counts["withheld"].append(((moderated_masks & withhold_candidates) != 0).sum(axis=1))
+                    granularity_counts["leaked"].append(((include_masks & revealed) != 0).sum(axis=1))
+                if self.geocoding_distance:
+                    distances = self.get_distances(include_masks)
+                    within.append((distances[:, :, None] <= np.asarray(thresholds, dtype=np.float64)).mean(axis=1))
+
+        results = {}
+        for granularity in GRANULARITIES:
+            _, revealed, withhold_candidates = self.bitmasks[granularity]
+            granularity_counts = {key: np.concatenate(values) for key, values in counts[granularity].items()}
+            recall, precision, f1 = binary_scores(granularity_counts["tp"], granularity_counts["fp"], granularity_counts["fn"])
+            withhold_total = int(np.count_nonzero(withhold_candidates))
+            leak_total = int(np.count_nonzero(revealed))
+            results[granularity] = {
+                "recall": summarize(recall, percentiles), "precision": summarize(precision, percentiles), "f1": summarize(f1, percentiles),
+                "withheld_proportion": summarize(granularity_counts["withheld"] / withhold_total if withhold_total else np.zeros(num_samples), percentiles),
+                "leaked_proportion": summarize(granularity_counts["leaked"] / leak_total if leak_total else np.zeros(num_samples), percentiles)}
+            if self.geocoding_distance and granularity in GEOCODING_GRANULARITIES and len(self.located_rows):
+                within_thresholds = np.concatenate(within)
+                results[granularity]["distances"] = {f"within {threshold} km": summarize(within_thresholds[:, threshold_idx], percentiles)
+                                                     for threshold_idx, threshold in enumerate(thresholds)}
+        return results
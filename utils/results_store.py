@@ -0,0 +1,91 @@
+import os
+import json
+from utils import profiling
+
+
+class DistanceResultsStore:
+    """
+    Indexed store for the geocoding distance results saved under api_distance_responses.
+
+    The results file is read once into an image_id -> record index so lookups are O(1).
+    New records are buffered in memory and appended to the file in batches. When the same
+    image_id appears more than once (e.g. after rerunning with --recompute_geocoding_results)
+    the last record wins.
+
+    With a write_file, new records are appended to it instead (records already in it are
+    loaded too), so processes sharing results_file never append to the same file.
+    """
+
+    def __init__(self, results_file, flush_every=256, write_file=None):
+        self.results_file = results_file
+        self.write_file = write_file or results_file
+        self.flush_every = flush_every
+        self.index = {}
+        self.pending = []
+        for file_path in dict.fromkeys([results_file, self.write_file]):
+            if not os.path.exists(file_path):
+                continue
+            with open(file_path, "r") as f:
+                num_lines = 0
+                for line in f:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    self.index[record["image_id"]] = record
+                    num_lines += 1
+                profiling.count_file_read(f, num_lines)
+
+    def __contains__(self, image_id):
+        return image_id in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, image_id):
+        return self.index.get(image_id)
+
+    def add(self, record):
+        self.index[record["image_id"]] = record
+        self.pending.append(record)
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        directory = os.path.dirname(self.write_file)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(self.write_file, "a") as f:
+            f.write("".join(json.dumps(record) + "\n" for record in self.pending))
+        self.pending = []
+
+    def compact(self):
+        # rewrite the file with one record per image, sorted by image_id
+        self.flush()
+        tmp_file = f"{self.results_file}.tmp"
+        with open(tmp_file, "w") as f:
+            f.write("".join(json.dumps(self.index[image_id]) + "\n"
+                            for image_id in sorted(self.index)))
+        os.replace(tmp_file, self.results_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+
+def compact_results_dir(results_dir="api_distance_responses"):
+    # dedup, sort and rewrite every results file in the directory
+    compacted = {}
+    for filename in sorted(os.listdir(results_dir)):
+        if not filename.endswith(".jsonl"):
+            continue
+        results_file = os.path.join(results_dir, filename)
+        with open(results_file, "r") as f:
+            num_lines = sum(1 for line in f if line.strip())
+        store = DistanceResultsStore(results_file)
+        store.compact()
+        compacted[filename] = (num_lines, len(store))
+    return compacted
@@ -0,0 +1,231 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from tqdm import tqdm
+from utils import profiling
+from utils.conversation_memo import get_conversation_memo
+from utils.decisions import load_decisions
+from utils.ground_truth_store import get_ground_truth_store
+from utils.metric_utils import BasicMetricsAccumulator, BootstrapAccumulator, WithheldLeakedAccumulator, \
+    StreamingBasicMetricsAccumulator, StreamingBootstrapAccumulator
+from utils.sharding import get_partial_accumulator, iter_shard_conversations
+from utils.streaming_evaluator import iter_conversations, stream_conversations, update_accumulators
+
+# experiments whose result is bound by the geocoding API, resolved on a thread pool
+IO_BOUND_EXPERIMENTS = {"geocoding_distance"}
+# experiments computed for all agents at once in this process
+TENSOR_EXPERIMENTS = {"privacy_utility"}
+
+
+class Task:
+    """
+    One experiment for one agent (and so one granularity).
+    """
+
+    def __init__(self, experiment, model, granularity, filename, shard=None, **kwargs):
+        self.experiment = experiment
+        self.model = model
+        self.granularity = granularity
+        self.filename = filename
+        # (shard_index, num_shards) to only compute the partial aggregate of a shard
+        self.shard = shard
+        self.kwargs = kwargs
+
+    @property
+    def key(self):
+        return (self.experiment, self.model)
+
+    @property
+    def streaming(self):
+        # read the answers file line by line in constant memory, see stream_conversations
+        return self.kwargs.get("streaming", False)
+
+    @property
+    def io_bound(self):
+        return self.experiment in IO_BOUND_EXPERIMENTS
+
+
+def expand_tasks(experiments, agent_results, experiment_kwargs=None, shard=None):
+    """
+    Expands the requested experiments into one task per agent x granularity x experiment.
+
+    Args:
+        experiments: names of the experiments to run, see get_accumulator.
+        agent_results: dict mapping each agent to its granularity and answers filename.
+        experiment_kwargs: optional dict of extra keyword arguments for each experiment.
+        shard: optional (shard_index, num_shards) of the conversations to evaluate, see utils.sharding.
+
+    Returns:
+        The list of tasks in experiment and agent order.
+    """
+    experiment_kwargs = experiment_kwargs or {}
+    tasks = []
+    for experiment in experiments:
+        for model, model_results_dict in agent_results.items():
+            granularity = model_results_dict["granularity"]
+            # geocoding distance is not defined for exact gps coordinates
+            if experiment == "geocoding_distance" and granularity == "exact_gps_coordinates":
+                continue
+            tasks.append(Task(experiment, model, granularity, model_results_dict["filename"], shard=shard,
+                              **experiment_kwargs.get(experiment, {})))
+    return tasks
+
+
+def get_accumulator(task):
+    if task.shard is not None:
+        return get_partial_accumulator(task, *task.shard)
+    if task.streaming:
+        kwargs = {key: value for key, value in task.kwargs.items() if key != "streaming"}
+        if task.experiment == "basic_metrics":
+            return StreamingBasicMetricsAccumulator(task.granularity, **kwargs)
+        if task.experiment == "bootstrap":
+            return StreamingBootstrapAccumulator(task.granularity, **kwargs)
+    if task.experiment == "basic_metrics":
+        return BasicMetricsAccumulator(task.granularity, **task.kwargs)
+    if task.experiment == "bootstrap":
+        return BootstrapAccumulator(task.granularity, **task.kwargs)
+    if task.experiment == "privacy_utility":
+        return WithheldLeakedAccumulator(task.granularity, **task.kwargs)
+    if task.experiment == "geocoding_distance":
+        # the geocoding subsystem (and its HTTP client) is only loaded by runs that geocode
+        from utils.geocoding_utils import GeocodingDistanceAccumulator
+        return GeocodingDistanceAccumulator(task.granularity, model_name=task.model, **task.kwargs)
+    raise ValueError(f"Unknown experiment: {task.experiment}")
+
+
+def get_group_conversations(tasks):
+    if tasks[0].shard is not None:
+        return iter_shard_conversations(tasks[0].filename, *tasks[0].shard)
+    if all(task.streaming for task in tasks):
+        return stream_conversations(tasks[0].filename)
+    return iter_conversations(tasks[0].filename)
+
+
+def profile_task_accumulator(task, accumulator):
+    return profiling.profile_accumulator(accumulator, experiment=task.experiment, model=task.model, granularity=task.granularity)
+
+
+def run_task_group(tasks, defer_io=False):
+    """
+    Runs the tasks of one answers file in a single pass over its conversations.
+
+    With defer_io, the I/O-bound tasks (geocoding) are fed by the pass but not resolved: their
+    accumulators are returned for the caller to resolve on its I/O pool.
+
+    Returns:
+        A dict mapping each task key to its result, and a dict mapping the key of each deferred
+        task to its accumulator.
+    """
+    accumulators = {task.key: get_accumulator(task) for task in tasks}
+    profiled_accumulators = {task.key: profile_task_accumulator(task, accumulators[task.key]) for task in tasks}
+    with profiling.span("evaluate_answers_file", filename=tasks[0].filename, tasks=len(tasks)):
+        update_accumulators(get_group_conversations(tasks), profiled_accumulators)
+    deferred = {task.key: accumulators[task.key] for task in tasks if defer_io and task.io_bound}
+    return {key: accumulator.result() for key, accumulator in profiled_accumulators.items() if key not in deferred}, deferred
+
+
+def _run_task_group_in_worker(tasks):
+    # return the profile records and the conversation memo entries of the worker along with the results
+    profiler = profiling.get_profiler()
+    conversation_memo = get_conversation_memo()
+    conversation_memo.start_delta()
+    group_results = run_task_group(tasks, defer_io=True)
+    return group_results, profiler.collect() if profiler is not None else None, conversation_memo.take_delta()
+
+
+def run_tensor_tasks(tasks):
+    # the privacy-utility tasks of all agents are computed at once on stacked tensors
+    from utils.privacy_tensor import compute_withheld_leaked_all
+    groups = {}
+    for task in tasks:
+        groups.setdefault(tuple(sorted(task.kwargs.items())), []).append(task)
+    results = {}
+    for kwargs, group in groups.items():
+        proportions = compute_withheld_leaked_all(list(dict.fromkeys(task.filename for task in group)), **dict(kwargs))
+        results.update({task.key: proportions[task.filename][task.granularity] for task in group})
+    return results
+
+
+def group_tasks(tasks):
+    # one group per answers file, so that every experiment of an agent shares one pass
+    groups = {}
+    for task in tasks:
+        groups.setdefault(task.filename, []).append(task)
+    return list(groups.values())
+
+
+def _init_worker(profile_origin_ns=None):
+    # a fresh profiler per worker, so records inherited from a forked parent are not reported twice
+    if profile_origin_ns is not None:
+        profiling.enable_profiling(profile_origin_ns)
+    # load the ground truths once per worker (inherited from the parent when forked)
+    with profiling.span("load_ground_truths"):
+        get_ground_truth_store()
+
+
+def run_tasks(tasks, jobs=1, io_jobs=4, progress=True):
+    """
+    Runs tasks in parallel, reading each answers file once: all the experiments of an agent are
+    fed by a single pass over its answers file, on a pool of `jobs` processes. The geocoding of
+    the conversations collected by the pass is then resolved on a pool of `io_jobs` threads in
+    this process (agents with only geocoding tasks run their pass on the thread pool too).
+    Privacy-utility tasks are first computed for all agents at once in this process, from the
+    decisions the passes then reuse. The conversation memo entries added by the workers are
+    merged into the memo of this process.
+
+    Returns:
+        A dict mapping each task key to its result. Results do not depend on completion order.
+    """
+    results = {}
+    bar = tqdm(total=len(tasks), disable=not progress)
+    tensor_tasks = [task for task in tasks if task.experiment in TENSOR_EXPERIMENTS and task.shard is None]
+    if tensor_tasks:
+        with profiling.span("run_tensor_tasks", tasks=len(tensor_tasks)):
+            results.update(run_tensor_tasks(tensor_tasks))
+        bar.update(len(tensor_tasks))
+    groups = group_tasks([task for task in tasks if task not in tensor_tasks])
+    if jobs <= 1:
+        for group in groups:
+            results.update(run_task_group(group)[0])
+            bar.update(len(group))
+        bar.close()
+        return results
+
+    cpu_groups = [group for group in groups if not all(task.io_bound for task in group)]
+    io_groups = [group for group in groups if all(task.io_bound for task in group)]
+    if cpu_groups:
+        # load the ground truths and decisions before forking so workers share them
+        with profiling.span("load_ground_truths"):
+            get_ground_truth_store()
+        with profiling.span("load_decisions", files=len(cpu_groups)):
+            for group in cpu_groups:
+                if group[0].shard is not None or not all(task.streaming for task in group):
+                    load_decisions(group[0].filename)
+    profiler = profiling.get_profiler()
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                             initargs=(profiler.origin_ns if profiler is not None else None,)) as process_pool, \
+            ThreadPoolExecutor(max_workers=max(1, io_jobs)) as thread_pool:
+        futures = {process_pool.submit(_run_task_group_in_worker, group): group for group in cpu_groups}
+        futures.update({thread_pool.submit(run_task_group, group): group for group in io_groups})
+        tasks_by_key = {task.key: task for task in tasks}
+        deferred_futures = set()
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                group = futures.pop(future)
+                if future in deferred_futures:
+                    group_results = {group[0].key: future.result()}
+                elif all(task.io_bound for task in group):
+                    group_results, _ = future.result()
+                else:
+                    (group_results, deferred), profile_records, memo_delta = future.result()
+                    if profile_records is not None:
+                        profiler.merge(profile_records)
+                    get_conversation_memo().merge(memo_delta)
+                    # resolve the geocoding of the conversations collected by the worker
+                    for key, accumulator in deferred.items():
+                        deferred_future = thread_pool.submit(profile_task_accumulator(tasks_by_key[key], accumulator).result)
+                        deferred_futures.add(deferred_future)
+                        futures[deferred_future] = [tasks_by_key[key]]
+                results.update(group_results)
+                bar.update(len(group_results))
+    bar.close()
+    return results
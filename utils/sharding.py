@@ -0,0 +1,185 @@
+import os
+import json
+import hashlib
+from utils import profiling
+from utils.metric_utils import BasicMetricsAccumulator, WithheldLeakedAccumulator, binary_confusion_counts, confusion_scores
+from utils.streaming_evaluator import Accumulator, iter_conversations
+
+# bump when the layout of the partial aggregates changes
+SHARD_FORMAT_VERSION = 2
+SHARD_DIR = "shards"
+
+
+def get_shard_index(image_id, num_shards):
+    # stable across processes and machines, unlike hash()
+    return int.from_bytes(hashlib.sha1(image_id.encode("utf-8")).digest()[:8], "little") % num_shards
+
+
+def get_shard_name(shard_index, num_shards):
+    return f"shard-{shard_index:05d}-of-{num_shards:05d}"
+
+
+def iter_shard_conversations(answers_file, shard_index, num_shards):
+    # the conversations of a decisions file whose image falls in the shard
+    for image_id, turn_numbers, moderated in iter_conversations(answers_file):
+        if get_shard_index(image_id, num_shards) == shard_index:
+            yield image_id, turn_numbers, moderated
+
+
+class ConfusionCountsAccumulator(BasicMetricsAccumulator):
+    # partial aggregate of the basic metrics and bootstrap experiments
+    def __init__(self, granularity, ground_truth_dir="moderation_decisions_ground_truth", **bootstrap_kwargs):
+        super().__init__(granularity, ground_truth_dir)
+
+    def result(self):
+        return {"confusion": binary_confusion_counts(self.predictions, self.ground_truths)}
+
+
+class WithheldLeakedCountsAccumulator(WithheldLeakedAccumulator):
+    # partial aggregate of the privacy-utility experiment
+    def result(self):
+        return {"withheld": [self.withheld, self.withheld_totals], "leaked": [self.leaked, self.leaked_totals]}
+
+
+class GeocodingDistanceCountsAccumulator(Accumulator):
+    # partial aggregate of the geocoding distance experiment: the counts within each threshold
+    # and the distances of the shard, for the distance indexes
+    def __init__(self, granularity, **distance_kwargs):
+        # the geocoding subsystem (and its HTTP client) is only loaded by shards that geocode
+        from utils.geocoding_utils import GeocodingDistanceAccumulator
+        self.accumulator = GeocodingDistanceAccumulator(granularity, **distance_kwargs)
+
+    def update(self, image_id, turn_numbers, moderated):
+        self.accumulator.update(image_id, turn_numbers, moderated)
+
+    def result(self):
+        distance_thresholds, all_distances = self.accumulator.result()
+        return {"within": [distance_thresholds[threshold] for threshold in self.accumulator.distance_kwargs["thresholds"]],
+                "all": distance_thresholds["all"], "distances": all_distances}
+
+
+def get_partial_accumulator(task, shard_index, num_shards):
+    if task.experiment in ("basic_metrics", "bootstrap"):
+        return ConfusionCountsAccumulator(task.granularity, **task.kwargs)
+    if task.experiment == "privacy_utility":
+        return WithheldLeakedCountsAccumulator(task.granularity, **task.kwargs)
+    if task.experiment == "geocoding_distance":
+        return GeocodingDistanceCountsAccumulator(task.granularity, model_name=task.model,
+                                                  shard_name=get_shard_name(shard_index, num_shards), **task.kwargs)
+    raise ValueError(f"Unknown experiment: {task.experiment}")
+
+
+def merge_partials(partial, other_partial):
+    # element-wise sum of two partial aggregates of the same task, distances are concatenated
+    if isinstance(partial, dict):
+        return {key: partial[key] + other_partial[key] if key == "distances" else merge_partials(partial[key], other_partial[key])
+                for key in partial}
+    if isinstance(partial, list):
+        return [merge_partials(value, other_value) for value, other_value in zip(partial, other_partial)]
+    return partial + other_partial
+
+
+def finalize_partial(task, partial):
+    """
+    Computes the result of a task from its merged partial aggregate, in the format of the
+    single-node result.
+    """
+    if task.experiment == "basic_metrics":
+        _, fp, fn, tp = partial["confusion"]
+        return confusion_scores(tp, fp, fn)
+    if task.experiment == "bootstrap":
+        from utils.bootstrap_utils import bootstrap_confusion_counts
+        num_bootstrap_samples = task.kwargs.get("num_bootstrap_samples", 500)
+        profiling.count("bootstrap_iterations", num_bootstrap_samples)
+        results = bootstrap_confusion_counts(partial["confusion"], num_bootstrap_samples=num_bootstrap_samples,
+                                             sample_size=task.kwargs.get("sample_size", 750), seed=task.kwargs.get("seed"))
+        return results["f1"]["mean"], results["f1"]["std"]
+    if task.experiment == "privacy_utility":
+        (withheld, withheld_total), (leaked, leaked_total) = partial["withheld"], partial["leaked"]
+        return (0 if withheld_total == 0 else withheld / withheld_total,
+                0 if leaked_total == 0 else leaked / leaked_total)
+    if task.experiment == "geocoding_distance":
+        distance_thresholds = dict(zip(task.kwargs["thresholds"], partial["within"]))
+        distance_thresholds["all"] = partial["all"]
+        return distance_thresholds, partial["distances"]
+    raise ValueError(f"Unknown experiment: {task.experiment}")
+
+
+def get_shard_params(task):
+    # experiment parameters the partial aggregates depend on, as they read back from JSON
+    return json.loads(json.dumps({key: value for key, value in task.kwargs.items() if key != "recompute"}))
+
+
+def get_shard_file(shard_dir, shard_index, num_shards):
+    return os.path.join(shard_dir, f"{get_shard_name(shard_index, num_shards)}.json")
+
+
+def save_shard(shard_dir, shard_index, num_shards, tasks, partials):
+    """
+    Saves the partial aggregates of one shard, one per task.
+    """
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+    shard_file = get_shard_file(shard_dir, shard_index, num_shards)
+    tmp_file = f"{shard_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump({"version": SHARD_FORMAT_VERSION, "shard_index": shard_index, "num_shards": num_shards,
+                   "tasks": [{"experiment": task.experiment, "model": task.model, "params": get_shard_params(task),
+                              "partial": partials[task.key]} for task in tasks]}, f)
+    os.replace(tmp_file, shard_file)
+    return shard_file
+
+
+def reduce_shards(shard_dir, num_shards, tasks):
+    """
+    Merges the partial aggregates of every shard into the results of the tasks.
+
+    Raises:
+        ValueError if a shard is missing, was written with another format or other experiment
+        parameters, or lacks one of the tasks.
+
+    Returns:
+        A dict mapping each task key to its result, as returned by run_tasks.
+    """
+    merged = {}
+    for shard_index in range(num_shards):
+        shard_file = get_shard_file(shard_dir, shard_index, num_shards)
+        if not os.path.exists(shard_file):
+            raise ValueError(f"Missing shard {shard_index} of {num_shards}: {shard_file}")
+        with open(shard_file, "r") as f:
+            shard = json.load(f)
+            profiling.count_file_read(f)
+        if shard["version"] != SHARD_FORMAT_VERSION:
+            raise ValueError(f"{shard_file} was written with shard format version {shard['version']}")
+        shard_partials = {(entry["experiment"], entry["model"]): entry for entry in shard["tasks"]}
+        for task in tasks:
+            entry = shard_partials.get(task.key)
+            if entry is None:
+                raise ValueError(f"{shard_file} has no results for {task.experiment} of {task.model}")
+            if entry["params"] != get_shard_params(task):
+                raise ValueError(f"{shard_file} was computed with other parameters for {task.experiment}: {entry['params']}")
+            merged[task.key] = entry["partial"] if task.key not in merged else merge_partials(merged[task.key], entry["partial"])
+    return {task.key: finalize_partial(task, merged[task.key]) for task in tasks}
+
+
+def merge_shard_results_files(results_dir="api_distance_responses"):
+    """
+    Appends the geocoding results saved by the shards under {results_dir}/shards to the results
+    files of their agents, then removes them. Run by the reduce step, the only writer.
+    """
+    shard_results_dir = os.path.join(results_dir, "shards")
+    if not os.path.isdir(shard_results_dir):
+        return 0
+    num_files = 0
+    for filename in sorted(os.listdir(shard_results_dir)):
+        if not filename.endswith(".jsonl"):
+            continue
+        # api_distance_results_{model}.shard-xxxxx-of-yyyyy.jsonl
+        results_file = os.path.join(results_dir, f"{filename[:-len('.jsonl')].rsplit('.', 1)[0]}.jsonl")
+        with open(os.path.join(shard_results_dir, filename), "r") as f:
+            records = f.read()
+        with open(results_file, "a") as f:
+            f.write(records)
+        os.remove(os.path.join(shard_results_dir, filename))
+        num_files += 1
+    return num_files
@@ -0,0 +1,84 @@
+import json
+from utils import profiling
+from utils.decisions import load_decisions, parse_decision
+
+
+def iter_conversations(answers_file):
+    """
+    Streams the conversations of a moderation decisions file.
+
+    Consecutive lines with the same image id form one conversation. The decisions are loaded
+    with load_decisions, so repeated runs read them from their binary sidecar.
+
+    Yields:
+        Tuples (image_id, turn_numbers, moderated) where moderated holds 1 for each turn the agent moderated ("Yes").
+    """
+    yield from load_decisions(answers_file).iter_conversations()
+
+
+def stream_conversations(answers_file):
+    """
+    Streams the conversations of a moderation decisions file line by line, in constant memory.
+
+    Unlike iter_conversations the file is neither loaded in full nor cached in a sidecar, for
+    decision files too large to hold in memory.
+
+    Yields:
+        The same (image_id, turn_numbers, moderated) tuples as iter_conversations.
+    """
+    image_id, turn_numbers, moderated = None, [], []
+    with open(answers_file, "r") as f:
+        num_lines = 0
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            num_lines += 1
+            line_image_id, turn_no, line_moderated = parse_decision(record["question_id"], record["predicted"])
+            if line_image_id != image_id and turn_numbers:
+                yield image_id, turn_numbers, moderated
+                turn_numbers, moderated = [], []
+            image_id = line_image_id
+            turn_numbers.append(turn_no)
+            moderated.append(line_moderated)
+        profiling.count_file_read(f, num_lines)
+    if turn_numbers:
+        yield image_id, turn_numbers, moderated
+
+
+class Accumulator:
+    """
+    A metric computed incrementally from the conversations of one decisions file.
+    """
+
+    def update(self, image_id, turn_numbers, moderated):
+        raise NotImplementedError
+
+    def result(self):
+        raise NotImplementedError
+
+
+def evaluate_answers_file(answers_file, accumulators):
+    """
+    Reads a decisions file once and feeds every conversation to all accumulators.
+
+    Args:
+        answers_file: path of the moderation decisions file.
+        accumulators: dict mapping a name to an Accumulator.
+
+    Returns:
+        A dict mapping each name to the result of its accumulator.
+    """
+    return evaluate_conversations(iter_conversations(answers_file), accumulators)
+
+
+def update_accumulators(conversations, accumulators):
+    # feeds (image_id, turn_numbers, moderated) conversations to all accumulators
+    for image_id, turn_numbers, moderated in conversations:
+        for accumulator in accumulators.values():
+            accumulator.update(image_id, turn_numbers, moderated)
+
+
+def evaluate_conversations(conversations, accumulators):
+    update_accumulators(conversations, accumulators)
+    return {name: accumulator.result() for name, accumulator in accumulators.items()}